@@ -0,0 +1,228 @@
+#!/usr/bin/python
+
+# Benchmarks for the uploaders and the organizer against synthetic data.
+#
+# Each stage runs in its own process so CPU time and peak RSS are measured
+# per stage:
+#   resize   - resize_image over the frames of all cameras
+#   archive  - archive_images2 and archive_timelapse_video
+#   upload   - cammy_put_d.ftp_putall against a local FTP server
+#   oneshot  - cammy_put.ftp_putall against a local FTP server
+#   organize - organize.organize over a synthetic Foscam record/ tree
+#
+# The FTP server is pyftpdlib running in the benchmark process, with
+# --latency added to every STOR and --failrate of them refused.
+
+import sys
+import os.path
+import os
+import time
+import json
+import random
+import resource
+import logging
+import argparse
+import subprocess
+import tempfile
+import shutil
+import threading
+from datetime import datetime
+from datetime import timedelta
+from multiprocessing.pool import ThreadPool
+import multiprocessing
+from PIL import Image
+
+STAGES = ['resize', 'archive', 'upload', 'oneshot', 'organize']
+
+def make_frames(imagedir, count, size, start):
+	# motion style frames, 20151117_211520_01.jpg, a few per second
+	if not os.path.isdir(imagedir):
+		os.makedirs(imagedir)
+	base = Image.merge('RGB', [Image.effect_noise(size, 40 + 20 * i) for i in range(3)])
+	for i in range(count):
+		tt = start + timedelta(seconds = i // 4)
+		fname = '{}_{:02d}.jpg'.format(tt.strftime('%Y%m%d_%H%M%S'), i % 4)
+		# shift the noise a little so frames are not identical
+		frame = base.rotate(i % 7, expand = False)
+		frame.save(os.path.join(imagedir, fname), 'JPEG', quality = 85)
+
+def make_movies(target, cameras, count, start, size = 1048576):
+	# Foscam layout, <camera>/record/MDalarm_YYYYMMDD_HHMMSS.mkv
+	data = os.urandom(size)
+	for c in range(cameras):
+		recorddir = os.path.join(target, 'FI9805W_{:012d}'.format(c), 'record')
+		os.makedirs(recorddir)
+		for i in range(count):
+			tt = start + timedelta(seconds = 45 * i)
+			fname = 'MDalarm_{}.mkv'.format(tt.strftime('%Y%m%d_%H%M%S'))
+			with open(os.path.join(recorddir, fname), 'wb') as f:
+				f.write(data)
+
+def start_ftp_server(root, latency, failrate):
+	from pyftpdlib.authorizers import DummyAuthorizer
+	from pyftpdlib.handlers import FTPHandler
+	from pyftpdlib.servers import ThreadedFTPServer
+
+	class BenchFTPHandler(FTPHandler):
+		def ftp_STOR(self, file, mode = 'w'):
+			time.sleep(latency)
+			if random.random() < failrate:
+				self.respond('451 Injected failure.')
+				return
+			return FTPHandler.ftp_STOR(self, file, mode)
+
+	authorizer = DummyAuthorizer()
+	authorizer.add_user('bench', 'bench', root, perm = 'elradfmw')
+	BenchFTPHandler.authorizer = authorizer
+	logging.getLogger('pyftpdlib').setLevel(logging.WARNING)
+	server = ThreadedFTPServer(('127.0.0.1', 0), BenchFTPHandler)
+	t = threading.Thread(target = server.serve_forever, name = 'ftpd')
+	t.daemon = True
+	t.start()
+	return server.address[1]
+
+def camera_dirs(workdir, args):
+	return [os.path.join(workdir, 'images', '{:02d}'.format(c + 1)) for c in range(args.cameras)]
+
+def archive_dir(imagedir):
+	# <workdir>/images/01 -> <workdir>/archive/01
+	return os.path.join(os.path.dirname(os.path.dirname(imagedir)), 'archive', os.path.basename(imagedir))
+
+def prepare(stage, workdir, args):
+	# returns the number of items the stage works on
+	start = datetime.now() - timedelta(minutes = 5)
+	if stage == 'organize':
+		make_movies(os.path.join(workdir, 'ftp'), args.cameras, args.movies, start - timedelta(days = 1))
+		return args.cameras * args.movies
+	for imagedir in camera_dirs(workdir, args):
+		make_frames(imagedir, args.frames, args.size, start)
+		os.makedirs(archive_dir(imagedir))
+	return args.cameras * args.frames
+
+def run(stage, workdir, args):
+	imagedirs = camera_dirs(workdir, args)
+
+	if stage == 'resize':
+		import cammy_put_d
+		for imagedir in imagedirs:
+			for fname in cammy_put_d.get_files(imagedir):
+				cammy_put_d.resize_image(imagedir, fname)
+
+	elif stage == 'archive':
+		import cammy_put_d
+		cammy_put_d.ARCHIVEMODE = args.archivemode
+		cammy_put_d.ARCHIVEFORMAT = args.archiveformat
+		for imagedir in imagedirs:
+			cammy_put_d.archive_images2(imagedir, archive_dir(imagedir), 10)
+			cammy_put_d.archive_timelapse_video(imagedir, archive_dir(imagedir))
+		cammy_put_d.PACKS.closeall()
+
+	elif stage == 'upload':
+		import cammy_put_d
+		port = start_ftp_server(os.path.join(workdir, 'ftproot'), args.latency / 1000.0, args.failrate)
+		cammy_put_d.FTPPOOL = cammy_put_d.FTPPool('127.0.0.1', port, 'bench', 'bench', args.sessions)
+		cammy_put_d.UPLOADERS = ThreadPool(args.sessions)
+		cammy_put_d.UPLOADAHEAD = args.sessions * 2
+		if args.resize:
+			cammy_put_d.RESIZERS = multiprocessing.Pool(args.resizers)
+			cammy_put_d.RESIZEAHEAD = args.resizers * 2
+		for imagedir in imagedirs:
+			cammy_put_d.ftp_putall(imagedir, True, archive_dir(imagedir), 10, args.resize)
+		if args.resize:
+			cammy_put_d.RESIZERS.close()
+			cammy_put_d.RESIZERS.join()
+
+	elif stage == 'oneshot':
+		import cammy_put
+		port = start_ftp_server(os.path.join(workdir, 'ftproot'), args.latency / 1000.0, args.failrate)
+		cammy_put.FTPPOOL = cammy_put.FTPPool('127.0.0.1', port, 'bench', 'bench', args.sessions)
+		cammy_put.HEALTH = cammy_put.ConnectionHealth()
+		for imagedir in imagedirs:
+			cammy_put.ftp_putall(imagedir, True, archive_dir(imagedir), 10, args.resize, args.sessions)
+
+	elif stage == 'organize':
+		import organize
+		organize.organize(os.path.join(workdir, 'ftp'))
+		organize.cleanup(os.path.join(workdir, 'ftp'), 10)
+		organize.RETENTION.wait()
+
+def run_stage(stage, args):
+	workdir = tempfile.mkdtemp(prefix = 'cammybench-', dir = args.workdir)
+	os.makedirs(os.path.join(workdir, 'ftproot'))
+	try:
+		count = prepare(stage, workdir, args)
+		before = resource.getrusage(resource.RUSAGE_SELF)
+		before_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+		started = time.time()
+		run(stage, workdir, args)
+		elapsed = time.time() - started
+		after = resource.getrusage(resource.RUSAGE_SELF)
+		after_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+	finally:
+		shutil.rmtree(workdir, True)
+
+	cpu = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime) + \
+		(after_children.ru_utime - before_children.ru_utime) + (after_children.ru_stime - before_children.ru_stime)
+	return {
+		'stage': stage,
+		'items': count,
+		'seconds': elapsed,
+		'cpu': cpu,
+		# ru_maxrss is in KB on Linux
+		'maxrss': max(after.ru_maxrss, after_children.ru_maxrss),
+	}
+
+def report(results):
+	print('{:<10} {:>7} {:>9} {:>10} {:>12} {:>10}'.format('stage', 'items', 'seconds', 'items/sec', 'cpu ms/item', 'peak MB'))
+	for r in results:
+		items = max(r['items'], 1)
+		print('{:<10} {:>7} {:>9.2f} {:>10.1f} {:>12.2f} {:>10.1f}'.format(r['stage'], r['items'], r['seconds'], \
+				r['items'] / r['seconds'] if r['seconds'] > 0 else 0, r['cpu'] * 1000.0 / items, r['maxrss'] / 1024.0))
+
+def main():
+
+	parser = argparse.ArgumentParser(description='Cammy tools benchmark.')
+	parser.add_argument('--stages', help='Stages to run', nargs='+', choices=STAGES, default=STAGES)
+	parser.add_argument('--stage', help=argparse.SUPPRESS, choices=STAGES, default=None)
+	parser.add_argument('--cameras', help='Number of cameras', default=2, type=int)
+	parser.add_argument('--frames', help='Frames per camera', default=200, type=int)
+	parser.add_argument('--size', help='Frame size WIDTHxHEIGHT', default='1920x1080')
+	parser.add_argument('--movies', help='Foscam movies per camera for the organize stage', default=500, type=int)
+	parser.add_argument('--latency', help='Milliseconds added to every STOR', default=20, type=float)
+	parser.add_argument('--failrate', help='Fraction of STORs that fail', default=0.0, type=float)
+	parser.add_argument('--sessions', help='Number of FTP sessions', default=3, type=int)
+	parser.add_argument('--resize', help='Resize frames during the upload stages', action='store_true', default=False)
+	parser.add_argument('--resizers', help='Number of resize processes in the upload stage', default=2, type=int)
+	parser.add_argument('--archivemode', help='Archive mode for the archive stage', choices=['copy', 'link'], default='copy')
+	parser.add_argument('--archiveformat', help='Archive format for the archive stage', choices=['files', 'pack'], default='files')
+	parser.add_argument('--workdir', help='Directory for the synthetic data', default=None)
+	parser.add_argument('--log', help='Log file, by default nothing is logged', default=None)
+	parser.add_argument('--json', help='Print results as JSON lines', action='store_true', default=False)
+
+	args = parser.parse_args()
+	args.size = tuple(int(v) for v in args.size.split('x'))
+
+	if args.stage:
+		if args.log:
+			logging.basicConfig(filename=args.log, level=logging.DEBUG, \
+					format="%(asctime)s [%(levelname)-5.5s] [%(threadName)s]  %(message)s")
+		else:
+			# injected failures would flood the terminal with tracebacks
+			logging.basicConfig(level=logging.CRITICAL)
+		print(json.dumps(run_stage(args.stage, args)))
+		return
+
+	# every stage in a fresh process, so peak RSS belongs to that stage
+	results = []
+	for stage in args.stages:
+		cmd = [sys.executable, os.path.abspath(__file__)] + sys.argv[1:] + ['--stage', stage]
+		out = subprocess.check_output(cmd).decode('utf-8')
+		results.append(json.loads(out.strip().splitlines()[-1]))
+		if args.json:
+			print(json.dumps(results[-1]))
+	if not args.json:
+		report(results)
+
+
+if __name__ == '__main__':
+	main()
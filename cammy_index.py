@@ -0,0 +1,223 @@
+#!/usr/bin/python
+
+# Time index over the archived frames and timelapse videos of cammy_put.py
+# and cammy_put_d.py and the organized Foscam movies of organize.py. The
+# tools given the same --index file add a row (camera, capture time, path,
+# size) for every file they place below a YYYYMMDD day directory, and the
+# rows of a day go when retention queues the day for removal. Queries are a
+# range scan on the capture time instead of a walk of the tree.
+#
+#   cammy_index.py --index PATH query FROM TO [--camera C...] [--kind K...] [--json]
+#   cammy_index.py --index PATH export FROM TO -o DIR [--camera C...] [--kind K...]
+#   cammy_index.py --index PATH scan ROOT...    (re)indexes existing archive or record dirs
+#
+# FROM and TO are local times, YYYY-MM-DD HH:MM[:SS]. Frames in packs
+# (--archiveformat pack) have the .pack as their path, see cammy_pack.py.
+
+import sys
+import os.path
+import os
+import re
+import time
+import json
+import logging
+import argparse
+import shutil
+import sqlite3
+import threading
+from cammy_retention import is_day_dir
+from cammy_pack import PackReader, read_index
+
+KINDS = {'.jpg': 'frame', '.avi': 'video', '.mkv': 'movie', '.mp4': 'movie'}
+CAPTURE_TIME = re.compile(r'(\d{8}_\d{6})')
+
+
+def capture_time(name):
+	# motion's 20151117_211520_01.jpg and Foscam's MDalarm_20151117_211520.mkv
+	# are both named after their local capture time
+	m = CAPTURE_TIME.search(name)
+	if not m:
+		return None
+	try:
+		return time.mktime(time.strptime(m.group(1), '%Y%m%d_%H%M%S'))
+	except ValueError:
+		return None
+
+def root_camera(root):
+	# archivedir/<camera> or <target>/<camera>/record
+	root = os.path.normpath(root)
+	if os.path.basename(root) == 'record':
+		root = os.path.dirname(root)
+	return os.path.basename(root)
+
+def kind_of(name):
+	return KINDS.get(os.path.splitext(name)[1].lower(), 'file')
+
+def parse_time(value):
+	for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+		try:
+			return time.mktime(time.strptime(value, fmt))
+		except ValueError:
+			pass
+	raise argparse.ArgumentTypeError('not a time: {}'.format(value))
+
+
+class TimeIndex(object):
+	# Several processes may write the same file, WAL lets them and readers
+	# go on side by side. Writers batch a pass worth of files into one
+	# transaction. A failing index never stops the archiving, it is only
+	# logged; 'scan' repairs the index later.
+
+	def __init__(self, path):
+		self.lock = threading.Lock()
+		self.db = sqlite3.connect(path, timeout = 30, check_same_thread = False)
+		self.db.execute('PRAGMA journal_mode=WAL')
+		self.db.execute('PRAGMA synchronous=NORMAL')
+		self.db.execute('CREATE TABLE IF NOT EXISTS items (camera TEXT, ts REAL, kind TEXT, root TEXT, day TEXT, ' \
+				'path TEXT, name TEXT, size INTEGER, PRIMARY KEY (path, name))')
+		self.db.execute('CREATE INDEX IF NOT EXISTS items_ts ON items (ts)')
+		self.db.execute('CREATE INDEX IF NOT EXISTS items_day ON items (root, day)')
+		self.db.commit()
+
+	def rows(self, root, files):
+		# files are (path, name, size) with path below root/YYYYMMDD
+		root = os.path.abspath(root)
+		camera = root_camera(root)
+		for path, name, size in files:
+			ts = capture_time(name)
+			if ts is None:
+				logging.debug("Not indexing {}, no capture time in the name.".format(name))
+				continue
+			path = os.path.abspath(path)
+			day = os.path.relpath(path, root).split(os.sep)[0]
+			yield (camera, ts, kind_of(name), root, day, path, name, size)
+
+	def add(self, root, files):
+		if not files:
+			return
+		try:
+			with self.lock:
+				self.db.executemany('INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?, ?, ?)', list(self.rows(root, files)))
+				self.db.commit()
+		except sqlite3.Error as e:
+			logging.warning("Cannot index {} files of {}: {}".format(len(files), root, e))
+
+	def remove_day(self, root, day):
+		try:
+			with self.lock:
+				self.db.execute('DELETE FROM items WHERE root = ? AND day = ?', (os.path.abspath(root), day))
+				self.db.commit()
+		except sqlite3.Error as e:
+			logging.warning("Cannot remove {} of {} from the index: {}".format(day, root, e))
+
+	def replace(self, root, files):
+		# the rows of root become exactly files
+		with self.lock:
+			self.db.execute('DELETE FROM items WHERE root = ?', (os.path.abspath(root),))
+			self.db.executemany('INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?, ?, ?)', list(self.rows(root, files)))
+			self.db.commit()
+
+	def query(self, start, end, cameras = None, kinds = None):
+		sql = 'SELECT camera, ts, kind, path, name, size FROM items WHERE ts >= ? AND ts < ?'
+		params = [start, end]
+		for column, values in (('camera', cameras), ('kind', kinds)):
+			if values:
+				sql += ' AND {} IN ({})'.format(column, ','.join('?' * len(values)))
+				params.extend(values)
+		with self.lock:
+			return self.db.execute(sql + ' ORDER BY ts, camera, name', params).fetchall()
+
+
+def scan(root):
+	# every file below root/YYYYMMDD/HH and every frame of root/YYYYMMDD/HH.pack
+	files = []
+	for day in sorted(os.listdir(root)):
+		daydir = os.path.join(root, day)
+		if not is_day_dir(day) or not os.path.isdir(daydir):
+			continue
+		for entry in sorted(os.listdir(daydir)):
+			path = os.path.join(daydir, entry)
+			if entry.endswith('.idx'):
+				for name, (offset, length, mtime) in read_index(path[:-4])[0].items():
+					files.append((path[:-4] + '.pack', name, length))
+			elif os.path.isdir(path):
+				for name in sorted(os.listdir(path)):
+					files.append((path, name, os.path.getsize(os.path.join(path, name))))
+	return files
+
+def export(rows, outdir):
+	# copies the items into outdir/<camera>/, frames of packs are extracted
+	readers = {}
+	try:
+		for camera, ts, kind, path, name, size in rows:
+			target = os.path.join(outdir, camera)
+			if not os.path.isdir(target):
+				os.makedirs(target)
+			try:
+				if path.endswith('.pack'):
+					if path not in readers:
+						readers[path] = PackReader(path)
+					data = readers[path].read(name)
+					with open(os.path.join(target, name), 'wb') as f:
+						f.write(data)
+				else:
+					shutil.copy2(os.path.join(path, name), target)
+			except (IOError, OSError, KeyError) as e:
+				# removed behind the index's back, 'scan' brings it up to date
+				logging.warning("Cannot export {} of {}: {}".format(name, path, e))
+				continue
+			print(os.path.join(target, name))
+	finally:
+		for reader in readers.values():
+			reader.close()
+
+def main():
+
+	parser = argparse.ArgumentParser(description='Cammy archive time index.')
+	parser.add_argument('--index', help='Index file, as given to the uploaders and organize.py', required=True)
+	commands = parser.add_subparsers(dest='command')
+	for command, description in (('query', 'List the items captured between FROM and TO'), \
+			('export', 'Copy the items captured between FROM and TO into a directory')):
+		p = commands.add_parser(command, help=description)
+		p.add_argument('start', metavar='FROM', type=parse_time)
+		p.add_argument('end', metavar='TO', type=parse_time)
+		p.add_argument('--camera', help='Only these cameras', nargs='+', default=None)
+		p.add_argument('--kind', help='Only these kinds', nargs='+', choices=sorted(set(KINDS.values())), default=None)
+		if command == 'query':
+			p.add_argument('--json', help='Print the items as JSON lines', action='store_true', default=False)
+		else:
+			p.add_argument('-o', dest='outdir', help='Directory to export to', required=True)
+	p = commands.add_parser('scan', help='Index existing archive or Foscam record directories')
+	p.add_argument('roots', nargs='+')
+	args = parser.parse_args()
+
+	logging.basicConfig(level=logging.INFO, format="%(message)s", stream=sys.stderr)
+	index = TimeIndex(args.index)
+
+	if args.command == 'scan':
+		for root in args.roots:
+			started = time.time()
+			files = scan(root)
+			index.replace(root, files)
+			logging.info("Indexed {} files of {} in {:.1f} s.".format(len(files), root, time.time() - started))
+		return
+	if args.command not in ('query', 'export'):
+		parser.print_help()
+		return
+
+	started = time.time()
+	rows = index.query(args.start, args.end, args.camera, args.kind)
+	logging.info("{} items in {:.1f} ms.".format(len(rows), (time.time() - started) * 1000))
+	if args.command == 'export':
+		export(rows, args.outdir)
+	elif args.json:
+		for camera, ts, kind, path, name, size in rows:
+			print(json.dumps({'camera': camera, 'time': ts, 'kind': kind, 'path': path, 'name': name, 'size': size}))
+	else:
+		for camera, ts, kind, path, name, size in rows:
+			print('{}\t{}\t{}\t{}\t{}'.format(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(ts)), camera, kind, \
+					size, os.path.join(path, name)))
+
+
+if __name__ == '__main__':
+	main()
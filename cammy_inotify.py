@@ -0,0 +1,98 @@
+#!/usr/bin/python
+
+# inotify(7) through ctypes, shared by cammy_put_d.py (camera directories)
+# and organize.py (Foscam record directories). Where libc has no inotify
+# every read() just times out and the callers rely on their periodic
+# rescans.
+
+import sys
+import os
+import time
+import errno
+import select
+import struct
+import logging
+import ctypes
+import ctypes.util
+
+# inotify(7) constants, see <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+INOTIFY_EVENT = struct.Struct('iIII')
+
+
+class Inotify(object):
+	# Reports files closed after writing or moved into the watched
+	# directories, as (key, name) with the key given to add().
+
+	def __init__(self):
+		self.fd = None
+		self.libc = None
+		self.wds = {}
+		try:
+			self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+			fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+			if fd < 0:
+				raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+			self.fd = fd
+		except (OSError, AttributeError) as e:
+			logging.warning('inotify not available ({}), falling back to polling.'.format(e))
+
+	def add(self, path, key):
+		# returns False when path cannot be watched
+		if self.fd is None:
+			return False
+		encoded = path
+		if not isinstance(encoded, bytes):
+			encoded = encoded.encode(sys.getfilesystemencoding())
+		wd = self.libc.inotify_add_watch(self.fd, encoded, IN_CLOSE_WRITE | IN_MOVED_TO)
+		if wd < 0:
+			logging.warning('inotify_add_watch failed for {}: {}'.format(path, os.strerror(ctypes.get_errno())))
+			return False
+		self.wds[wd] = key
+		return True
+
+	def watching(self):
+		return list(self.wds.values())
+
+	def read(self, timeout):
+		# Returns a list of (key, name), empty on timeout and None when the
+		# kernel queue overflowed and events were lost.
+		if self.fd is None:
+			time.sleep(timeout)
+			return []
+
+		ready, _, _ = select.select([self.fd], [], [], timeout)
+		if not ready:
+			return []
+
+		events = []
+		while True:
+			try:
+				buf = os.read(self.fd, 65536)
+			except OSError as e:
+				if e.errno in (errno.EAGAIN, errno.EINTR):
+					break
+				raise
+			offset = 0
+			while offset < len(buf):
+				wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(buf, offset)
+				offset += INOTIFY_EVENT.size
+				name = buf[offset:offset + length].rstrip(b'\0')
+				offset += length
+				if not isinstance(name, str):
+					name = name.decode(sys.getfilesystemencoding())
+				if mask & IN_Q_OVERFLOW:
+					logging.warning('inotify queue overflow, rescanning everything.')
+					return None
+				if wd in self.wds:
+					events.append((self.wds[wd], name))
+		return events
+
+	def close(self):
+		if self.fd is not None:
+			os.close(self.fd)
+			self.fd = None
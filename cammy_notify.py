@@ -0,0 +1,44 @@
+#!/usr/bin/python
+
+# Tells a running cammy_put_d.py --socket that motion wrote a new frame, for
+# example from motion.conf:
+#
+#   on_picture_save /usr/local/bin/cammy_notify.py %f
+#
+# Only the standard library pieces needed to send one datagram are imported,
+# so this returns in milliseconds instead of starting a whole uploader. The
+# argument is a camera directory, a file in it or a camera name from
+# --cameras.
+
+import sys
+import os
+import socket
+
+SOCKET = '/var/run/motion/cammyput.sock'
+
+def main(argv):
+	path = SOCKET
+	names = argv[1:]
+	if len(names) >= 2 and names[0] == '--socket':
+		path = names[1]
+		names = names[2:]
+	if not names:
+		sys.stderr.write('usage: {} [--socket PATH] DIR|FILE|CAMERA...\n'.format(argv[0]))
+		return 2
+
+	sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+	try:
+		for name in names:
+			if os.path.exists(name):
+				name = os.path.abspath(name)
+			sock.sendto(name.encode('utf-8'), path)
+	except socket.error as e:
+		sys.stderr.write('cammy_notify: cannot notify {}: {}\n'.format(path, e))
+		return 1
+	finally:
+		sock.close()
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv))
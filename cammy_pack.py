@@ -0,0 +1,292 @@
+#!/usr/bin/python
+
+# Hourly archive packs, written by cammy_put.py and cammy_put_d.py with
+# --archiveformat pack. Instead of one file per frame below
+# archivedir/YYYYMMDD/HH/, the frames of an hour are appended to
+# archivedir/YYYYMMDD/HH.pack and HH.idx gets one line per frame:
+#
+#   <name> TAB <offset> TAB <length> TAB <mtime>
+#
+# Both files are only ever appended to, and an index line is written after
+# the frame data it points to. A crash therefore leaves at worst a partial
+# index line or a tail of the pack no line points to, both are cut off the
+# next time the pack is opened for writing. After a power cut the index may
+# also point past a pack whose data never reached the disk, those lines are
+# dropped as well. Frames only leave their source once the pack is synced.
+# Reading one frame is a lookup in the index and a single read from the
+# pack.
+#
+#   cammy_pack.py list PACK...
+#   cammy_pack.py extract PACK [NAME...] [-o DIR]
+#   cammy_pack.py cat PACK NAME > frame.jpg
+#   cammy_pack.py pack HOURDIR...      packs the frames of old YYYYMMDD/HH dirs
+#
+# PACK is the hour with or without the .pack or .idx extension.
+
+import sys
+import os.path
+import os
+import time
+import logging
+import argparse
+import threading
+import collections
+
+
+def pack_base(path):
+	# archivedir/20151117/21.pack, .idx or just .../21 -> archivedir/20151117/21
+	base, ext = os.path.splitext(path)
+	return base if ext in ('.pack', '.idx') else path.rstrip(os.sep)
+
+def index_line(name, offset, length, mtime):
+	return '{}\t{}\t{}\t{:.3f}\n'.format(name, offset, length, mtime).encode('utf-8')
+
+def read_index(base):
+	# returns {name: (offset, length, mtime)} in the order written and the
+	# length of the index up to its last complete line
+	index = collections.OrderedDict()
+	valid = 0
+	try:
+		with open(base + '.idx', 'rb') as f:
+			for line in f:
+				if not line.endswith(b'\n'):
+					break
+				fields = line.decode('utf-8').rstrip('\n').split('\t')
+				if len(fields) == 4:
+					index[fields[0]] = (int(fields[1]), int(fields[2]), float(fields[3]))
+				valid += len(line)
+	except IOError:
+		pass
+	return index, valid
+
+
+class PackReader(object):
+
+	def __init__(self, path):
+		self.base = pack_base(path)
+		self.index = read_index(self.base)[0]
+		self.pack = open(self.base + '.pack', 'rb')
+
+	def names(self):
+		return list(self.index)
+
+	def __contains__(self, name):
+		return name in self.index
+
+	def read(self, name):
+		offset, length, mtime = self.index[name]
+		self.pack.seek(offset)
+		return self.pack.read(length)
+
+	def close(self):
+		self.pack.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+
+class PackWriter(object):
+
+	def __init__(self, path):
+		self.base = pack_base(path)
+		if not os.path.isdir(os.path.dirname(self.base)):
+			os.makedirs(os.path.dirname(self.base))
+		self.index, valid = read_index(self.base)
+		end = max([offset + length for offset, length, mtime in self.index.values()] or [0])
+		self.idx = open(self.base + '.idx', 'ab')
+		self.pack = open(self.base + '.pack', 'ab')
+		size = os.fstat(self.pack.fileno()).st_size
+		if size < end:
+			# the index outlived the data, keep the lines the pack still holds
+			lost = [name for name, (offset, length, mtime) in self.index.items() if offset + length > size]
+			logging.warning("Pack {}.pack is {} bytes short, dropping {} frames from the index.".format(self.base, \
+					end - size, len(lost)))
+			for name in lost:
+				del self.index[name]
+			lines = [index_line(name, *entry) for name, entry in self.index.items()]
+			os.ftruncate(self.idx.fileno(), 0)
+			self.idx.write(b''.join(lines))
+			self.idx.flush()
+			valid = sum(len(line) for line in lines)
+			end = max([offset + length for offset, length, mtime in self.index.values()] or [0])
+		# drop what an interrupted add() left behind
+		if os.fstat(self.idx.fileno()).st_size > valid:
+			logging.warning("Truncating index {}.idx to {} bytes.".format(self.base, valid))
+			os.ftruncate(self.idx.fileno(), valid)
+		if os.fstat(self.pack.fileno()).st_size > end:
+			logging.warning("Truncating pack {}.pack to {} bytes.".format(self.base, end))
+			os.ftruncate(self.pack.fileno(), end)
+		self.offset = end
+		self.added = 0
+
+	def __contains__(self, name):
+		return name in self.index
+
+	def add(self, name, src):
+		# appends the file src as name, returns the bytes added
+		st = os.stat(src)
+		length = 0
+		with open(src, 'rb') as f:
+			while True:
+				block = f.read(1048576)
+				if not block:
+					break
+				self.pack.write(block)
+				length += len(block)
+		self.pack.flush()
+		self.idx.write(index_line(name, self.offset, length, st.st_mtime))
+		self.idx.flush()
+		self.index[name] = (self.offset, length, st.st_mtime)
+		self.offset += length
+		self.added += 1
+		return length
+
+	def sync(self):
+		# the frames added so far survive a power cut
+		for f in (self.pack, self.idx):
+			os.fsync(f.fileno())
+
+	def close(self):
+		self.sync()
+		for f in (self.pack, self.idx):
+			f.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+
+class HourlyPacks(object):
+	# The pack each archive dir currently appends to. A camera's frames
+	# arrive in time order, so the pack of the previous hour is closed as
+	# soon as a frame of another hour turns up, and close_past() closes it
+	# when the camera goes quiet. Appends go through add() so a close from
+	# another thread never hits a writer in use, and sync() comes before the
+	# archived frames are removed.
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.writers = {}  # archive dir -> PackWriter
+
+	def writer(self, archivedir, hourdir):
+		# callers hold self.lock
+		writer = self.writers.get(archivedir)
+		if writer is not None and writer.base == hourdir:
+			return writer
+		if writer is not None:
+			self.closed(writer)
+		writer = self.writers[archivedir] = PackWriter(hourdir)
+		return writer
+
+	def add(self, archivedir, hourdir, name, src):
+		# returns the bytes added, None when the pack already has name
+		with self.lock:
+			writer = self.writer(archivedir, hourdir)
+			if name in writer:
+				return None
+			return writer.add(name, src)
+
+	def sync(self, archivedir):
+		with self.lock:
+			writer = self.writers.get(archivedir)
+			if writer is not None:
+				writer.sync()
+
+	def close_past(self, archivedir, now = None):
+		# closes the pack of archivedir if its hour is over
+		hour = time.strftime('%Y%m%d%H', time.localtime(now))
+		with self.lock:
+			writer = self.writers.get(archivedir)
+			if writer is not None and ''.join(writer.base.split(os.sep)[-2:]) < hour:
+				self.closed(writer)
+				del self.writers[archivedir]
+
+	def closed(self, writer):
+		writer.close()
+		logging.info("Closed pack {}.pack, {} frames added, {} in total, {} bytes.".format(writer.base, writer.added, \
+				len(writer.index), writer.offset))
+
+	def closeall(self):
+		with self.lock:
+			for writer in self.writers.values():
+				self.closed(writer)
+			self.writers = {}
+
+
+def extract(path, names, outdir):
+	with PackReader(path) as reader:
+		for name in names or reader.names():
+			if name not in reader:
+				logging.error("{} is not in {}".format(name, reader.base))
+				continue
+			dst = os.path.join(outdir, name)
+			with open(dst, 'wb') as f:
+				f.write(reader.read(name))
+			mtime = reader.index[name][2]
+			os.utime(dst, (mtime, mtime))
+			print(dst)
+
+def pack_hour(hourdir):
+	# moves the frames of an archivedir/YYYYMMDD/HH directory into HH.pack,
+	# other files (timelapse videos) stay where they are
+	hourdir = hourdir.rstrip(os.sep)
+	frames = sorted(f for f in os.listdir(hourdir) if f.endswith('.jpg'))
+	if not frames:
+		logging.info("No frames to pack in {}".format(hourdir))
+		return
+	with PackWriter(hourdir) as writer:
+		for fname in frames:
+			if fname not in writer:
+				writer.add(fname, os.path.join(hourdir, fname))
+	# only once close() has synced the pack
+	for fname in frames:
+		os.remove(os.path.join(hourdir, fname))
+	if not os.listdir(hourdir):
+		os.rmdir(hourdir)
+	logging.info("Packed {} frames into {}.pack".format(writer.added, writer.base))
+
+def main():
+
+	parser = argparse.ArgumentParser(description='Cammy hourly archive packs.')
+	commands = parser.add_subparsers(dest='command')
+	p = commands.add_parser('list', help='List the frames of packs')
+	p.add_argument('packs', nargs='+')
+	p = commands.add_parser('extract', help='Extract frames of a pack, all of them by default')
+	p.add_argument('pack')
+	p.add_argument('names', nargs='*')
+	p.add_argument('-o', dest='outdir', help='Directory to extract to', default='.')
+	p = commands.add_parser('cat', help='Write one frame to stdout')
+	p.add_argument('pack')
+	p.add_argument('name')
+	p = commands.add_parser('pack', help='Move the frames of archive hour directories into packs')
+	p.add_argument('hourdirs', nargs='+')
+	args = parser.parse_args()
+
+	logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+	if args.command == 'list':
+		for path in args.packs:
+			for name, (offset, length, mtime) in read_index(pack_base(path))[0].items():
+				print('{}\t{}\t{}'.format(name, length, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(mtime))))
+	elif args.command == 'extract':
+		if not os.path.isdir(args.outdir):
+			os.makedirs(args.outdir)
+		extract(args.pack, args.names, args.outdir)
+	elif args.command == 'cat':
+		with PackReader(args.pack) as reader:
+			out = getattr(sys.stdout, 'buffer', sys.stdout)
+			out.write(reader.read(args.name))
+	elif args.command == 'pack':
+		for hourdir in args.hourdirs:
+			pack_hour(hourdir)
+	else:
+		parser.print_help()
+
+
+if __name__ == '__main__':
+	main()
@@ -9,15 +9,25 @@ import traceback
 import logging
 import logging.handlers
 import argparse
-from ftplib import FTP
 import ftplib
 import shutil
 from PIL import Image
 import subprocess
-import tempfile
+import io
+from multiprocessing.pool import ThreadPool
+from cammy_put_d import FTPPool, ConnectionHealth, backoff_delay, draft_image
+from cammy_retention import Retention
+from cammy_pack import HourlyPacks
+from cammy_index import TimeIndex
 
 PIDLOCKFP = None
-FTPH = None
+FTPPOOL = None
+HEALTH = None
+ARCHIVEQUOTA = None
+ARCHIVEFORMAT = 'files'
+RETENTION = Retention()
+PACKS = HourlyPacks()
+INDEX = None
 
 def is_running(pidfname):
 	global PIDLOCKFP
@@ -39,16 +49,17 @@ def cleanup(pidfname):
 
 
 def archive_cleanup(archivedir, archivedays):
+	# the removals run in the background, main waits for them before exiting
 	logging.info("Cleaning from archive {} days {}...".format(archivedir, archivedays))
-	day_dirs = sorted(os.listdir(archivedir), reverse = True)
-	for day_dir in day_dirs[archivedays:]:
-		logging.info("Removing {}".format(day_dir))
-		shutil.rmtree(os.path.join(archivedir, day_dir), True)
+	RETENTION.register(archivedir, archivedays, ARCHIVEQUOTA)
+	RETENTION.enforce(archivedir)
+	PACKS.close_past(archivedir)
 	logging.info("Cleaning of archive done.")
 
 def archive_images2(imagedir, archivedir, archivedays):
 	archive_cleanup(archivedir, archivedays)
 	logging.info("Archiving...")
+	indexed = []
 	for fname in get_images(imagedir):
 		# split apart the image filename into pieces. The filename from motion
 		# is formatted: 20151117_211520_01
@@ -60,54 +71,57 @@ def archive_images2(imagedir, archivedir, archivedays):
 		target = os.path.join(archivedir, yyyymmdd, hh)
 		logging.info("Archiving {} to {}".format(fname, target))
 
+		if ARCHIVEFORMAT == 'pack':
+			nbytes = PACKS.add(archivedir, target, fname, os.path.join(imagedir, fname))
+			if nbytes is None:
+				logging.warning("File {} already exists in {}.pack during archiving.".format(fname, target))
+			else:
+				RETENTION.add(archivedir, yyyymmdd, nbytes)
+				indexed.append((target + '.pack', fname, nbytes))
+			continue
 		if os.path.isfile(os.path.join(target,fname)):
 			logging.warning("File {} already exists in {} during archiving.".format(fname, target))
 			continue
 		if not os.path.isdir(target):
 			os.makedirs(target)
 		shutil.copy(os.path.join(imagedir, fname), target)
+		size = os.path.getsize(os.path.join(target, fname))
+		RETENTION.add(archivedir, yyyymmdd, size)
+		indexed.append((target, fname, size))
+	if ARCHIVEFORMAT == 'pack':
+		# before the frames can be uploaded and removed
+		PACKS.sync(archivedir)
+	if INDEX:
+		INDEX.add(archivedir, indexed)
 	logging.info("Archiving done.")
 
-def resize_image(imagedir, imagefname, targetfile):
+def resize_image(imagedir, imagefname):
+	# returns the resized JPEG in a memory buffer
 	infile = os.path.join(imagedir, imagefname)
 	im = Image.open(infile)
+	draft_image(im)
 	im.thumbnail( (2000,720) )
-	im.save(targetfile, "JPEG", quality = 60)
-	logging.info('Resizing {} to {}'.format(infile, targetfile.name))
+	data = io.BytesIO()
+	im.save(data, "JPEG", quality = 60)
+	logging.info('Resizing {} to {} bytes'.format(infile, data.tell()))
+	data.seek(0)
+	return data
 
 def get_images(image_dir):
 	fnames = sorted(os.listdir(image_dir))
 	return fnames
 
-def ftp_callback(block):
-	logging.info('Sent block...')
-
-def get_ftphandle(username, password):
-	global FTPH
-	if not FTPH:
-		logging.info('Connecting to FTP server.')
-		FTPH = FTP(timeout=60)
-		FTPH.set_debuglevel(2)
-		FTPH.connect('ftp.cammy.com',10021)
-		FTPH.login(username, password)
-	return FTPH
-
-def close_ftphandle():
-	global FTPH
-	try:
-		if FTPH:
-			FTPH.quit()
-	except ftplib.all_errors as e:
-		logging.exception('Exception during closing the FTP handle')
-	FTPH = None
-
-def ftp_put(ftph, imagedir, imagefile):
+def ftp_put(ftph, imagedir, imagefile, data = None):
 	sent = False
 	try:
 		imagefname = os.path.join(imagedir, imagefile)
 		logging.info("FTP STOR {}".format(imagefname))
-		resp = ftph.storbinary("STOR " + imagefile, open(imagefname,'rb'), blocksize = 4096, callback = ftp_callback)
-		ftph.voidcmd('NOOP')
+		if data:
+			data.seek(0)
+			resp = ftph.storbinary("STOR " + imagefile, data, blocksize = 65536)
+		else:
+			with open(imagefname,'rb') as f:
+				resp = ftph.storbinary("STOR " + imagefile, f, blocksize = 65536)
 		logging.info("FTP STOR response code {}".format(resp))
 		sent = True
 	except ftplib.all_errors as e:
@@ -129,54 +143,63 @@ def get_fileage(imagedir, fname):
 		i = 0 
 	return i
 
-def ftp_putall(imagedir, username, password, delete, archivedir, archivedays, resize):
-	fnames = get_images(imagedir)
-
-	if archivedir:
-		archive_images2(imagedir, archivedir, archivedays)
-		
-
-	i = 0
-	retrycount = 0
-
-	for i in range(len(fnames)):
-		fname = fnames[i]
+def put_image(imagedir, fname, delete, resize):
+	if get_fileage(imagedir, fname) > (60*60) and delete:
+		logging.warning("Frame drop! Dropping {}".format(fname))
+		remove_image(imagedir, fname)
+		return False
 
-		if fname.endswith('_sml.jpg'):
-			continue
 
-		logging.info("Putting image {}, {} of {}".format(fname, i, len(fnames)))
+	data = None
+	if resize:
+		data = resize_image(imagedir, fname)
 
-		if get_fileage(imagedir, fname) > (60*60) and delete:
-			logging.warning("Frame drop! Dropping {}".format(fname))
-			remove_image(imagedir, fname)
+	ok = False
+	retrycount = 0
+	while not ok and retrycount < 10:
+		if retrycount:
+			time.sleep(backoff_delay(retrycount))
+		if not HEALTH.allow():
+			logging.info('FTP circuit is open, leaving {} for the next run.'.format(fname))
+			break
+		try:
+			ftph = FTPPOOL.acquire()
+		except ftplib.all_errors as e:
+			logging.exception('Exception during connecting to FTP server')
+			HEALTH.failure()
+			retrycount += 1
 			continue
+		ok = ftp_put(ftph, imagedir, fname, data)
+		FTPPOOL.release(ftph, broken = not ok)
+		if ok:
+			HEALTH.success()
+		else:
+			HEALTH.failure()
+			logging.info('Problem during storing {}, retrying'.format(fname))
+			retrycount += 1
 
 
-		orig_fname = fname
-		tmpfile = tempfile.NamedTemporaryFile()
-		if resize:
-			resize_image(imagedir, fname, tmpfile)
-			fname = tmpfile.name
+	if delete and ok:
+		remove_image(imagedir, fname)
+	return ok
 
-		ok = False
-		retrycount = 0
-		while not ok and retrycount < 10:
-			ftph = get_ftphandle(username, password)
-			ok = ftp_put(ftph, imagedir, fname)
-			if not ok:
-				logging.info('Problem during storing {}, retrying'.format(fname))
-				close_ftphandle()
-				retrycount += 1
+def ftp_putall(imagedir, delete, archivedir, archivedays, resize, sessions):
+	fnames = get_images(imagedir)
 
+	if archivedir:
+		archive_images2(imagedir, archivedir, archivedays)
+		
 
-		if delete:
-			remove_image(imagedir, orig_fname)
-			
+	def put(i):
+		logging.info("Putting image {}, {} of {}".format(fnames[i], i, len(fnames)))
+		return put_image(imagedir, fnames[i], delete, resize)
 
-	
+	pool = ThreadPool(sessions)
+	sent = pool.map(put, [i for i in range(len(fnames)) if not fnames[i].endswith('_sml.jpg')])
+	pool.close()
 
-	close_ftphandle()
+	FTPPOOL.closeall()
+	return sent.count(True)
 	
 	
 
@@ -192,6 +215,12 @@ def main():
 	parser.add_argument('--resize', help='Resize images before sending to cammy', action='store_true', default=False)
 	parser.add_argument('--archivedir', help='Archive directory', default=None)
 	parser.add_argument('--archivedays', help='Number of days of history to keep in archive', default=10)
+	parser.add_argument('--archiveformat', help='one file per frame, or the frames of each hour appended to one pack file (see cammy_pack.py)', choices=['files', 'pack'], default='files')
+	parser.add_argument('--index', help='Time index of the archive shared with organize.py, see cammy_index.py', default=None)
+	parser.add_argument('--archivequota', help='Megabytes of archive to keep, oldest days are removed first', default=None, type=int)
+	parser.add_argument('--ftphost', help='FTP server host', default='ftp.cammy.com')
+	parser.add_argument('--ftpport', help='FTP server port', default=10021, type=int)
+	parser.add_argument('--ftpsessions', help='Number of FTP sessions uploading in parallel', default=3, type=int)
 	parser.add_argument('--retrytimeout', help='How many minutes to keep waiting to grab pid lock for sending files', default=5)
 
 
@@ -225,14 +254,31 @@ def main():
 		return
 
 
+	global FTPPOOL, HEALTH, ARCHIVEQUOTA, ARCHIVEFORMAT, INDEX
+	ARCHIVEFORMAT = args.archiveformat
+	if args.index:
+		INDEX = TimeIndex(args.index)
+		RETENTION.index = INDEX
+	if args.archivequota:
+		ARCHIVEQUOTA = args.archivequota * 1048576
+	FTPPOOL = FTPPool(args.ftphost, args.ftpport, args.username, args.password, args.ftpsessions)
+	HEALTH = ConnectionHealth()
+
 	more = True
 	while more:
-		ftp_putall(args.imagedir, args.username, args.password, args.delete, args.archivedir, args.archivedays, args.resize)
-		if len(get_images(args.imagedir))>0 and args.delete:
+		sent = ftp_putall(args.imagedir, args.delete, args.archivedir, args.archivedays, args.resize, args.ftpsessions)
+		if sent == 0:
+			# whatever is left stays for the next run
+			if HEALTH.is_open():
+				logging.warning('FTP server unavailable, giving up for now.')
+			more = False
+		elif len(get_images(args.imagedir))>0 and args.delete:
 			more = True
 			logging.info('More images to upload, sending again.')
 		else:
 			more = False
+	PACKS.closeall()
+	RETENTION.wait()
 	cleanup(args.pidfile)
 	logging.info("Finished")
 
@@ -0,0 +1,478 @@
+#!/usr/bin/python3
+
+# asyncio engine for the cammy uploader, a drop-in replacement for
+# cammy_put_d.py taking the same options. All cameras are tasks on one
+# event loop in one thread:
+#   - every camera waits for a wakeup (poll timer, inotify with --watch or
+#     a cammy_notify.py datagram with --socket) and then runs a pass
+#   - frames go out over a pool of non-blocking FTP sessions
+#   - directory scans, archiving and journal writes run on a single helper
+#     thread, so the disk never blocks the loop
+#   - resizing runs in --resizers processes, retention on its own timer
+# Python 3 only, the archive, journal, policy and metrics code is shared
+# with cammy_put_d.py.
+
+import os.path
+import os
+import time
+import re
+import socket
+import logging
+import traceback
+import asyncio
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import cammy_put_d as cammy
+
+PASV_ADDRESS = re.compile(r'(\d+),(\d+),(\d+),(\d+),(\d+),(\d+)')
+
+class FTPError(Exception):
+	pass
+
+class AsyncFTP(object):
+	# Just enough of RFC 959 to log in and STOR binary files in passive
+	# mode. Like ftplib, the data connection goes to the control host and
+	# not to the address in the PASV reply.
+
+	def __init__(self, host, port, timeout = 60):
+		self.host = host
+		self.port = port
+		self.timeout = timeout
+		self.reader = None
+		self.writer = None
+
+	async def _readline(self, reader):
+		line = await asyncio.wait_for(reader.readline(), self.timeout)
+		if not line:
+			raise FTPError('connection closed by server')
+		return line.decode('latin-1').rstrip('\r\n')
+
+	async def reply(self):
+		line = await self._readline(self.reader)
+		if line[3:4] == '-':
+			# multi-line reply, ends with the code and a space
+			code = line[:3]
+			while True:
+				more = await self._readline(self.reader)
+				line += '\n' + more
+				if more[:3] == code and more[3:4] == ' ':
+					break
+		return line
+
+	async def command(self, cmd, expect):
+		self.writer.write((cmd + '\r\n').encode('latin-1'))
+		await asyncio.wait_for(self.writer.drain(), self.timeout)
+		resp = await self.reply()
+		if not resp.startswith(expect):
+			raise FTPError(resp)
+		return resp
+
+	async def login(self, username, password):
+		self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+		resp = await self.reply()
+		if not resp.startswith('2'):
+			raise FTPError(resp)
+		resp = await self.command('USER ' + username, ('2', '3'))
+		if resp.startswith('3'):
+			await self.command('PASS ' + password, '2')
+		await self.command('TYPE I', '2')
+
+	async def stor(self, name, data, blocksize, callback = None):
+		resp = await self.command('PASV', '227')
+		address = PASV_ADDRESS.search(resp)
+		if not address:
+			raise FTPError('cannot parse PASV reply {}'.format(resp))
+		port = int(address.group(5)) * 256 + int(address.group(6))
+		dreader, dwriter = await asyncio.wait_for(asyncio.open_connection(self.host, port), self.timeout)
+		try:
+			await self.command('STOR ' + name, '1')
+			for offset in range(0, len(data), blocksize):
+				block = data[offset:offset + blocksize]
+				dwriter.write(block)
+				await asyncio.wait_for(dwriter.drain(), self.timeout)
+				if callback:
+					await callback(block)
+		finally:
+			dwriter.close()
+		resp = await self.reply()
+		if not resp.startswith('2'):
+			raise FTPError(resp)
+		return resp
+
+	def close(self):
+		if self.writer:
+			self.writer.close()
+			self.writer = None
+
+class AsyncFTPPool(object):
+	# The asyncio counterpart of cammy_put_d.FTPPool: at most size logged in
+	# sessions, idle ones get a NOOP before reuse, broken ones are dropped.
+
+	def __init__(self, host, port, username, password, size, idlecheck = 30):
+		self.host = host
+		self.port = port
+		self.username = username
+		self.password = password
+		self.idlecheck = idlecheck
+		self.slots = asyncio.Semaphore(size)
+		self.idle = []  # (session, last used)
+
+	async def acquire(self):
+		await self.slots.acquire()
+		try:
+			while self.idle:
+				ftp, last = self.idle.pop()
+				if time.time() - last < self.idlecheck:
+					return ftp
+				try:
+					await ftp.command('NOOP', '2')
+					return ftp
+				except (FTPError, OSError, asyncio.TimeoutError) as e:
+					logging.info('Dropping stale FTP session: {}'.format(e))
+					ftp.close()
+			logging.info('Connecting to FTP server {}:{}.'.format(self.host, self.port))
+			cammy.METRICS.inc('cammy_ftp_connects_total')
+			ftp = AsyncFTP(self.host, self.port)
+			try:
+				await ftp.login(self.username, self.password)
+			except:
+				ftp.close()
+				raise
+			return ftp
+		except:
+			self.slots.release()
+			raise
+
+	def release(self, ftp, broken = False):
+		if broken:
+			ftp.close()
+		else:
+			self.idle.append((ftp, time.time()))
+		self.slots.release()
+
+	def closeall(self):
+		for ftp, last in self.idle:
+			ftp.close()
+		self.idle = []
+
+
+class Engine(object):
+
+	def __init__(self, args):
+		self.args = args
+		self.loop = None
+		self.ftppool = None
+		self.wakeups = {}
+		# one helper thread for the disk, the loop itself never blocks on it
+		self.disk = ThreadPoolExecutor(1, thread_name_prefix = 'disk')
+		self.resizers = None
+		if args.resize:
+			# forkserver, as the loop already runs threads when the first frame is resized
+			self.resizers = ProcessPoolExecutor(args.resizers, mp_context = multiprocessing.get_context('forkserver'))
+
+	def io(self, func, *args):
+		return self.loop.run_in_executor(self.disk, func, *args)
+
+	def wake(self, camera):
+		self.wakeups[camera].set()
+
+	async def transferred(self, block):
+		cammy.TRANSFERS.add(len(block))
+		if cammy.BWLIMIT:
+			wait = cammy.BWLIMIT.reserve(len(block))
+			if wait > 0:
+				await asyncio.sleep(wait)
+
+	async def ftp_put(self, ftp, imagedir, fname, data):
+		logging.info("FTP STOR {}".format(os.path.join(imagedir, fname)))
+		started = time.time()
+		resp = await ftp.stor(fname, data, cammy.get_blocksize(len(data)), self.transferred)
+		elapsed = max(time.time() - started, 0.001)
+		logging.info("FTP STOR response code {} ({} bytes, {:.1f} KB/s)".format(resp, len(data), len(data) / 1024.0 / elapsed))
+		cammy.METRICS.inc('cammy_upload_bytes_total', (('camera', cammy.get_camera(imagedir)),), len(data))
+
+	async def upload_file(self, imagedir, fname, data):
+		# as cammy_put_d.upload_file: up to 10 attempts with backoff, none
+		# while the circuit breaker is open
+		labels = (('camera', cammy.get_camera(imagedir)),)
+		started = time.time()
+		if cammy.TRACER:
+			cammy.TRACER.mark(imagedir, fname, 'upload_start', started)
+		uploaded = False
+		retrycount = 0
+		while not uploaded and retrycount < 10:
+			if retrycount:
+				await asyncio.sleep(cammy.backoff_delay(retrycount))
+			if not cammy.HEALTH.allow():
+				logging.info('FTP circuit is open, leaving {} queued.'.format(fname))
+				break
+			if retrycount:
+				cammy.METRICS.inc('cammy_upload_retries_total', labels)
+			try:
+				ftp = await self.ftppool.acquire()
+			except (FTPError, OSError, asyncio.TimeoutError) as e:
+				logging.error('Exception during connecting to FTP server: {}'.format(e))
+				cammy.HEALTH.failure()
+				retrycount += 1
+				continue
+			try:
+				await self.ftp_put(ftp, imagedir, fname, data)
+				uploaded = True
+			except (FTPError, OSError, asyncio.TimeoutError) as e:
+				logging.error('Exception during putting image {}: {}'.format(fname, e))
+			self.ftppool.release(ftp, broken = not uploaded)
+			if uploaded:
+				cammy.HEALTH.success()
+			else:
+				cammy.HEALTH.failure()
+				logging.info('Problem during storing {}, retrying'.format(fname))
+				retrycount += 1
+		cammy.METRICS.observe('cammy_upload_seconds', labels, time.time() - started)
+		if uploaded:
+			cammy.METRICS.inc('cammy_frames_uploaded_total', labels)
+			if cammy.TRACER:
+				cammy.TRACER.mark(imagedir, fname, 'upload_end', retries = retrycount)
+		return uploaded
+
+	async def put_frame(self, imagedir, fname, slots):
+		try:
+			if self.resizers:
+				result = await self.loop.run_in_executor(self.resizers, cammy.resize_frame, *cammy.resize_submit(imagedir, fname))
+				data = cammy.resized_frame(imagedir, fname, result)
+			else:
+				data = await self.io(read_file, os.path.join(imagedir, fname))
+			uploaded = await self.upload_file(imagedir, fname, data)
+			if uploaded:
+				await self.io(cammy.remove_file, imagedir, fname)
+				if cammy.TRACER:
+					await self.io(cammy.TRACER.finish, imagedir, [fname], 'uploaded')
+			return uploaded
+		except Exception as e:
+			logging.exception('Unexpected exception during putting image')
+			return False
+		finally:
+			slots.release()
+
+	async def putall(self, imagedir, archivedir):
+		# one camera, the same pass as cammy_put_d.ftp_putall
+		if not self.args.delete:
+			return False
+		up_count = 0
+		started = time.time()
+		journal = await self.io(cammy.get_journal, imagedir)
+		policy = cammy.get_policy(imagedir)
+		labels = (('camera', cammy.get_camera(imagedir)),)
+		if journal and time.time() - journal.pruned > 3600:
+			await self.io(journal.prune, 86400)
+		while True:
+			snapshot = await self.io(cammy.DirSnapshot, imagedir)
+			fnames = snapshot.files()
+			logging.info('^^^ Processing {}, number of images = {}'.format(imagedir, len(fnames)))
+			cammy.METRICS.set('cammy_queue_depth', labels, len(fnames))
+			if len(fnames) == 0:
+				break
+			if cammy.TRACER:
+				cammy.TRACER.detected(imagedir, fnames)
+
+			if journal:
+				await self.io(journal.mark, [f for f in fnames if not journal.state(f)], 'seen')
+
+			if archivedir:
+				archive_started = time.time()
+				await self.io(cammy.archive_images2, imagedir, archivedir, self.args.archivedays, journal, snapshot)
+				await self.io(cammy.archive_timelapse_video, imagedir, archivedir, snapshot)
+				cammy.METRICS.observe('cammy_archive_seconds', labels, time.time() - archive_started)
+
+			frames = []
+			leftovers = []
+			for fname in fnames:
+				if fname.endswith('_sml.jpg'):
+					continue
+				if journal and journal.state(fname) in ('uploaded', 'dropped'):
+					leftovers.append(fname)
+					continue
+				frames.append(fname)
+
+			# during an outage the drain rate is stale, frames only go at MAXAGE
+			outage = cammy.HEALTH.is_open()
+			frames, dropped = policy.plan(imagedir, frames, snapshot, thin = not outage)
+			for fname in dropped:
+				logging.warning("Frame drop! Dropping {}".format(fname))
+			await self.io(remove_files, imagedir, leftovers + dropped)
+			if journal:
+				await self.io(journal.mark, dropped, 'dropped')
+			if cammy.TRACER:
+				await self.io(cammy.TRACER.finish, imagedir, dropped, 'dropped')
+
+			if outage:
+				logging.info('FTP circuit is open, leaving {} frames of {} queued.'.format(len(frames), imagedir))
+				break
+
+			if cammy.DEDUPER:
+				duplicates = await self.io(find_duplicates, imagedir, frames, snapshot)
+				await self.io(remove_files, imagedir, duplicates)
+				if journal:
+					await self.io(journal.mark, duplicates, 'dropped')
+				if cammy.TRACER:
+					await self.io(cammy.TRACER.finish, imagedir, duplicates, 'duplicate')
+				duplicates = set(duplicates)
+				frames = [f for f in frames if f not in duplicates]
+
+			# uploads start in the policy's order, at most two per session in flight
+			pass_started = time.time()
+			slots = asyncio.Semaphore(self.args.ftpsessions * 2)
+			tasks = []
+			for i, fname in enumerate(frames):
+				if cammy.HEALTH.is_open():
+					break
+				await slots.acquire()
+				logging.info("Putting image {}, {} of {}".format(fname, i, len(frames)))
+				tasks.append(asyncio.ensure_future(self.put_frame(imagedir, fname, slots)))
+			# journaled once per pass, as in cammy_put_d.ftp_putall
+			sent = [fname for fname, uploaded in zip(frames, await asyncio.gather(*tasks)) if uploaded]
+			if journal:
+				await self.io(journal.mark, sent, 'uploaded')
+			pass_count = len(sent)
+			up_count += pass_count
+			policy.uploaded(pass_count, time.time() - pass_started)
+			if pass_count < len(frames):
+				break
+
+		elapsed = time.time() - started
+		logging.info('@@@ Finished processing {}. Uploaded {} images in {:.1f}s, {:.2f} frames/sec.'.format(imagedir, up_count, \
+				elapsed, up_count / elapsed if elapsed > 0 else 0))
+		cammy.log_resized(imagedir)
+		return up_count > 0
+
+	async def camera(self, camera, passes):
+		# a wakeup while a pass runs means one more pass afterwards
+		imagedir = os.path.join(self.args.imagedir, camera)
+		archivedir = os.path.join(self.args.archivedir, camera) if self.args.archivedir else None
+		wakeup = self.wakeups[camera]
+		while True:
+			await wakeup.wait()
+			wakeup.clear()
+			uploaded = False
+			async with passes:
+				logging.info('Scanning camera {}...'.format(camera))
+				try:
+					uploaded = await self.putall(imagedir, archivedir)
+				except Exception as e:
+					logging.exception('Pass of camera {} failed'.format(camera))
+			if uploaded:
+				# so cammy sees the next frames as a new event
+				await asyncio.sleep(self.args.cooldown)
+
+	async def rescan(self, interval):
+		while True:
+			for camera in self.args.cameras:
+				self.wake(camera)
+			await asyncio.sleep(interval)
+
+	async def retention(self, interval = 3600):
+		# cameras without frames run no passes, so their archive is cleaned here
+		while True:
+			await asyncio.sleep(interval)
+			for camera in self.args.cameras:
+				try:
+					await self.io(cammy.archive_cleanup, os.path.join(self.args.archivedir, camera), self.args.archivedays)
+				except Exception as e:
+					logging.exception('Retention of camera {} failed'.format(camera))
+
+	def watch(self):
+		camdirs = dict((camera, os.path.join(self.args.imagedir, camera)) for camera in self.args.cameras)
+		watcher = cammy.DirWatcher(camdirs)
+		if watcher.fd is not None:
+			self.loop.add_reader(watcher.fd, lambda: [self.wake(camera) for camera in watcher.wait(0)])
+
+	def listen(self):
+		camdirs = dict((os.path.abspath(os.path.join(self.args.imagedir, camera)), camera) for camera in self.args.cameras)
+		try:
+			os.unlink(self.args.socket)
+		except OSError:
+			pass
+		sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+		sock.setblocking(False)
+		sock.bind(self.args.socket)
+		os.chmod(self.args.socket, 0o660)
+		logging.info('Listening for notifications on {}.'.format(self.args.socket))
+
+		def received():
+			while True:
+				try:
+					name = sock.recv(4096).decode('utf-8', 'replace').strip()
+				except BlockingIOError:
+					return
+				camera = cammy.notify_camera(name, camdirs)
+				if camera is None:
+					logging.warning('Notification for unknown camera {}.'.format(name))
+					continue
+				logging.debug('Notification for camera {}.'.format(camera))
+				cammy.METRICS.inc('cammy_notifications_total', (('camera', camera),))
+				self.wake(camera)
+		self.loop.add_reader(sock.fileno(), received)
+		self.sock = sock
+
+	async def run(self):
+		args = self.args
+		self.loop = asyncio.get_event_loop()
+		self.ftppool = AsyncFTPPool(args.ftphost, args.ftpport, args.username, args.password, args.ftpsessions)
+		passes = asyncio.Semaphore(args.workers)
+		for camera in args.cameras:
+			self.wakeups[camera] = asyncio.Event()
+		tasks = [self.camera(camera, passes) for camera in args.cameras]
+		if args.watch:
+			self.watch()
+		if args.socket:
+			self.listen()
+		# with events the scan is only a safety net
+		tasks.append(self.rescan(args.rescan if args.watch or args.socket else 1))
+		if args.archivedir:
+			tasks.append(self.retention())
+		try:
+			await asyncio.gather(*tasks)
+		finally:
+			self.ftppool.closeall()
+			cammy.PACKS.closeall()
+
+
+def read_file(path):
+	with open(path, 'rb') as f:
+		return f.read()
+
+def remove_files(imagedir, fnames):
+	for fname in fnames:
+		cammy.remove_file(imagedir, fname)
+
+def find_duplicates(imagedir, frames, snapshot):
+	duplicates = [f for f in frames if cammy.DEDUPER.duplicate(imagedir, f)]
+	for fname in duplicates:
+		logging.info("Skipping {}, it looks like the previous frame.".format(fname))
+		cammy.DEDUPER.skipped(imagedir, fname, snapshot.size(fname))
+	return duplicates
+
+
+def main():
+
+	parser = cammy.build_parser()
+	args = parser.parse_args()
+	cammy.configure(parser, args)
+
+	cammy.setup_logging(args.log)
+
+	logging.info('CammyPut async started.')
+
+	cammy.start_metrics(args)
+
+	asyncio.run(Engine(args).run())
+
+	logging.info("Finished")
+
+
+if __name__ == '__main__':
+	try:
+		main()
+	except KeyboardInterrupt as e:
+		traceback.print_exc()
+	except Exception as e:
+		traceback.print_exc()
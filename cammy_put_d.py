@@ -12,23 +12,306 @@ from ftplib import FTP
 import ftplib
 from PIL import Image
 import subprocess
-import tempfile
+import io
 import shutil
+import socket
+import errno
+import threading
+try:
+	import queue
+except ImportError:
+	import Queue as queue
+
+import collections
+import math
+import random
+import bisect
+import json
+import zlib
+try:
+	from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+	from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+import sqlite3
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from cammy_retention import Retention
+from cammy_inotify import Inotify
+from cammy_pack import HourlyPacks
+from cammy_index import TimeIndex
+try:
+	import numpy
+except ImportError:
+	numpy = None
+try:
+	from os import scandir
+except ImportError:
+	scandir = None
+
+FTPPOOL = None
+UPLOADERS = None
+UPLOADAHEAD = 1
+ARCHIVEMODE = 'copy'
+ARCHIVEFORMAT = 'files'
+JOURNALDIR = None
+BLOCKSIZE = 0
+BWLIMIT = None
+ORDER = 'oldest'
+MAXAGE = 60*30
+THINAGE = 120
+POLICIES = {}
+JOURNALS = {}
+RESIZERS = None
+RESIZEAHEAD = 1
+ARCHIVEQUOTA = None
+DEDUPER = None
+TRACER = None
+FRAMEBYTES = None
+CAMERARATE = None
+QUALITIES = {}  # imagedir -> (quality, shrink) for the next frame
+ENCODES = collections.defaultdict(collections.Counter)
+RETENTION = Retention()
+PACKS = HourlyPacks()
+INDEX = None
+
+class DirWatcher(Inotify):
+	# Waits for motion to finish writing frames into the camera directories.
+	# Without inotify every wait() just times out and the caller falls back
+	# to its periodic rescan.
+
+	def __init__(self, camdirs, extensions = ('JPG', 'AVI')):
+		Inotify.__init__(self)
+		self.cameras = list(camdirs.keys())
+		self.extensions = tuple(extensions)
+		for camera, camdir in camdirs.items():
+			self.add(camdir, camera)
+		if self.fd is not None:
+			logging.info('Watching {} camera directories with inotify.'.format(len(self.wds)))
+
+	def wait(self, timeout):
+		# Returns the set of cameras that got new files, empty on timeout.
+		events = self.read(timeout)
+		if events is None:
+			return set(self.cameras)
+		return set(camera for camera, name in events if name.upper().endswith(self.extensions))
 
-FTPH = None
 
 def archive_cleanup(archivedir, archivedays):
+	# decides from the tracked day sizes, the removal itself runs in the background
 	logging.info("Cleaning from archive {} days {}...".format(archivedir, archivedays))
-	day_dirs = sorted(os.listdir(archivedir), reverse = True)
-	for day_dir in day_dirs[archivedays:]:
-		logging.info("Removing {}".format(day_dir))
-		shutil.rmtree(os.path.join(archivedir, day_dir), True)
+	RETENTION.register(archivedir, archivedays, ARCHIVEQUOTA)
+	RETENTION.enforce(archivedir)
+	PACKS.close_past(archivedir)
+	if ARCHIVEQUOTA:
+		METRICS.set('cammy_archive_bytes', (('camera', get_camera(archivedir)),), RETENTION.usage(archivedir))
 	logging.info("Cleaning of archive done.")
 
-def archive_images2(imagedir, archivedir, archivedays):
+class FrameJournal(object):
+	# Remembers what happened to each frame of a camera (seen, archived,
+	# uploaded, dropped) in a small SQLite file. A pass only archives frames
+	# the journal does not know yet, and after a crash frames that were
+	# already uploaded are removed instead of being sent again. The states
+	# are kept in memory as well so lookups never hit the disk.
+
+	def __init__(self, path):
+		self.lock = threading.Lock()
+		self.db = sqlite3.connect(path, check_same_thread = False)
+		self.db.execute('PRAGMA journal_mode=WAL')
+		self.db.execute('PRAGMA synchronous=NORMAL')
+		self.db.execute('CREATE TABLE IF NOT EXISTS frames (name TEXT PRIMARY KEY, state TEXT, updated REAL)')
+		self.states = dict(self.db.execute('SELECT name, state FROM frames'))
+		self.pruned = 0
+		logging.info('Opened journal {} with {} frames.'.format(path, len(self.states)))
+
+	def state(self, fname):
+		return self.states.get(fname)
+
+	def mark(self, fnames, state):
+		now = time.time()
+		with self.lock:
+			for fname in fnames:
+				self.states[fname] = state
+			self.db.executemany('INSERT OR REPLACE INTO frames VALUES (?, ?, ?)', [(fname, state, now) for fname in fnames])
+			self.db.commit()
+
+	def prune(self, maxage):
+		# forget frames that were finished with long ago
+		cutoff = time.time() - maxage
+		with self.lock:
+			self.db.execute("DELETE FROM frames WHERE updated < ? AND state IN ('uploaded', 'dropped')", (cutoff,))
+			self.db.commit()
+			self.states = dict(self.db.execute('SELECT name, state FROM frames'))
+			self.pruned = time.time()
+
+# name: (type, help) of everything put into METRICS
+METRIC_HELP = {
+	'cammy_queue_depth': ('gauge', 'Frames in the camera directory at the start of the last pass.'),
+	'cammy_upload_seconds': ('histogram', 'Time to upload one frame, retries included.'),
+	'cammy_upload_bytes_total': ('counter', 'Bytes sent with successful STORs.'),
+	'cammy_frames_uploaded_total': ('counter', 'Frames uploaded.'),
+	'cammy_frames_dropped_total': ('counter', 'Frames dropped without upload, by reason.'),
+	'cammy_upload_retries_total': ('counter', 'Failed upload attempts that were retried.'),
+	'cammy_ftp_connects_total': ('counter', 'FTP sessions opened.'),
+	'cammy_ftp_circuit_state': ('gauge', 'FTP circuit breaker state, 0 closed, 1 half-open, 2 open.'),
+	'cammy_ftp_circuit_changes_total': ('counter', 'FTP circuit breaker state changes, by new state.'),
+	'cammy_archive_seconds': ('histogram', 'Time spent archiving the frames and videos of a pass.'),
+	'cammy_frames_deduped_total': ('counter', 'Frames not sent because they looked like the previous frame.'),
+	'cammy_dedupe_bytes_saved_total': ('counter', 'Bytes of the frames not sent as duplicates.'),
+	'cammy_notifications_total': ('counter', 'New frame notifications received on the --socket.'),
+	'cammy_resized_frames_total': ('counter', 'Frames resized for upload.'),
+	'cammy_resized_bytes_total': ('counter', 'Bytes of the resized frames.'),
+	'cammy_resize_encodes_total': ('counter', 'JPEG encodes needed to fit the resized frames into their byte budget.'),
+	'cammy_resize_quality': ('gauge', 'JPEG quality the byte budget settled on for the last frame.'),
+	'cammy_archive_bytes': ('gauge', 'Disk space used by the archive of a camera, tracked with --archivequota.'),
+}
+
+class Metrics(object):
+	# Counters, gauges and histograms for a Prometheus scraper. An update is
+	# a dictionary operation under a lock, the text format is only produced
+	# when the metrics are scraped or written out.
+
+	BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.values = {}      # (name, labels) -> value
+		self.histograms = {}  # (name, labels) -> [count per bucket..., +Inf, sum]
+
+	def inc(self, name, labels = (), value = 1):
+		with self.lock:
+			self.values[(name, labels)] = self.values.get((name, labels), 0) + value
+
+	def set(self, name, labels, value):
+		with self.lock:
+			self.values[(name, labels)] = value
+
+	def observe(self, name, labels, value):
+		i = bisect.bisect_left(self.BUCKETS, value)
+		with self.lock:
+			h = self.histograms.get((name, labels))
+			if h is None:
+				h = self.histograms[(name, labels)] = [0] * (len(self.BUCKETS) + 2)
+			h[i] += 1
+			h[-1] += value
+
+	def render(self):
+		with self.lock:
+			values = sorted(self.values.items())
+			histograms = sorted((k, list(h)) for k, h in self.histograms.items())
+		lines = []
+		for name in sorted(set([n for (n, l), v in values] + [n for (n, l), h in histograms])):
+			kind, text = METRIC_HELP.get(name, ('untyped', name))
+			lines.append('# HELP {} {}'.format(name, text))
+			lines.append('# TYPE {} {}'.format(name, kind))
+			for (n, labels), v in values:
+				if n == name:
+					lines.append('{}{} {}'.format(name, format_labels(labels), v))
+			for (n, labels), h in histograms:
+				if n != name:
+					continue
+				count = 0
+				for le, c in zip(self.BUCKETS + ('+Inf',), h[:-1]):
+					count += c
+					lines.append('{}_bucket{} {}'.format(name, format_labels(labels + (('le', le),)), count))
+				lines.append('{}_sum{} {}'.format(name, format_labels(labels), h[-1]))
+				lines.append('{}_count{} {}'.format(name, format_labels(labels), count))
+		return '\n'.join(lines) + '\n'
+
+def format_labels(labels):
+	if not labels:
+		return ''
+	return '{' + ','.join('{}="{}"'.format(k, v) for k, v in labels) + '}'
+
+METRICS = Metrics()
+
+class MetricsHandler(BaseHTTPRequestHandler):
+	def do_GET(self):
+		body = METRICS.render().encode('utf-8')
+		self.send_response(200)
+		self.send_header('Content-Type', 'text/plain; version=0.0.4')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		pass
+
+def serve_metrics(port):
+	server = HTTPServer(('', port), MetricsHandler)
+	t = threading.Thread(target=server.serve_forever, name='metrics')
+	t.daemon = True
+	t.start()
+	logging.info('Serving metrics on port {}.'.format(port))
+
+def write_metrics(path, interval):
+	# for the node_exporter textfile collector, replaced atomically
+	while True:
+		try:
+			with open(path + '.tmp', 'w') as f:
+				f.write(METRICS.render())
+			os.rename(path + '.tmp', path)
+		except (IOError, OSError) as e:
+			logging.warning('Cannot write metrics to {}: {}'.format(path, e))
+		time.sleep(interval)
+
+def get_camera(imagedir):
+	return os.path.basename(os.path.normpath(imagedir))
+
+def get_journal(imagedir):
+	if not JOURNALDIR:
+		return None
+	camera = get_camera(imagedir)
+	if camera not in JOURNALS:
+		JOURNALS[camera] = FrameJournal(os.path.join(JOURNALDIR, camera + '.db'))
+	return JOURNALS[camera]
+
+def copy_file(src, dst):
+	# copy without passing the data through user space where the kernel can
+	if hasattr(os, 'sendfile'):
+		with open(src, 'rb') as fsrc:
+			with open(dst, 'wb') as fdst:
+				size = os.fstat(fsrc.fileno()).st_size
+				offset = 0
+				while offset < size:
+					sent = os.sendfile(fdst.fileno(), fsrc.fileno(), offset, size - offset)
+					if sent == 0:
+						break
+					offset += sent
+		shutil.copymode(src, dst)
+	else:
+		shutil.copy(src, dst)
+
+def archive_file(imagedir, fname, target, rename = False):
+	# In link mode frames that still have to be uploaded are hardlinked and
+	# videos are renamed into the archive, so no data is read or written.
+	# Across filesystems (or where links are not supported) it falls back to
+	# a kernel side copy.
+	src = os.path.join(imagedir, fname)
+	dst = os.path.join(target, fname)
+	if ARCHIVEMODE == 'link':
+		try:
+			if rename:
+				os.rename(src, dst)
+			else:
+				os.link(src, dst)
+			return
+		except OSError as e:
+			if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+				raise
+			logging.debug("Cannot link {} into {}, copying: {}".format(fname, target, e))
+		copy_file(src, dst)
+	else:
+		shutil.copy(src, target)
+
+def archive_images2(imagedir, archivedir, archivedays, journal = None, snapshot = None):
 	archive_cleanup(archivedir, archivedays)
 	logging.info("Archiving images...")
-	for fname in get_files(imagedir):
+	snapshot = snapshot or DirSnapshot(imagedir)
+	archived = []
+	indexed = []
+	for fname in snapshot.files():
+		if journal and journal.state(fname) not in (None, 'seen'):
+			continue
 		# split apart the image filename into pieces. The filename from motion
 		# is formatted: 20151117_211520_01
 		# and the target folder structure will be YYYYMMDD/HH/file.jpg
@@ -42,21 +325,40 @@ def archive_images2(imagedir, archivedir, archivedays):
 		target = os.path.join(archivedir, yyyymmdd, hh)
 		logging.info("Archiving {} to {}".format(fname, target))
 
-		if os.path.isfile(os.path.join(target,fname)):
+		if ARCHIVEFORMAT == 'pack':
+			# appended to YYYYMMDD/HH.pack, see cammy_pack.py
+			nbytes = PACKS.add(archivedir, target, fname, os.path.join(imagedir, fname))
+			if nbytes is None:
+				logging.warning("File {} already exists in {}.pack during archiving.".format(fname, target))
+			else:
+				RETENTION.add(archivedir, yyyymmdd, nbytes)
+				indexed.append((target + '.pack', fname, nbytes))
+		elif snapshot.archived(target, fname):
 			logging.warning("File {} already exists in {} during archiving.".format(fname, target))
 		else:
-			if not os.path.isdir(target):
-				os.makedirs(target)
-			shutil.copy(os.path.join(imagedir, fname), target)
+			snapshot.archiving(target, fname)
+			archive_file(imagedir, fname, target)
+			RETENTION.add(archivedir, yyyymmdd, snapshot.size(fname))
+			indexed.append((target, fname, snapshot.size(fname)))
+		archived.append(fname)
 
+	if ARCHIVEFORMAT == 'pack':
+		# before the frames can be uploaded and removed
+		PACKS.sync(archivedir)
+	if INDEX:
+		INDEX.add(archivedir, indexed)
+	if journal:
+		journal.mark(archived, 'archived')
 	logging.info("Archiving images done.")
 
 
-def archive_timelapse_video(imagedir, archivedir):
+def archive_timelapse_video(imagedir, archivedir, snapshot = None):
 	logging.info("Archiving timelapse...")
-	for fname in get_files(imagedir, 'AVI'):
+	snapshot = snapshot or DirSnapshot(imagedir)
+	indexed = []
+	for fname in snapshot.files('AVI'):
 		
-		i = int( time.time() - os.path.getmtime(os.path.join(imagedir, fname)))
+		i = int( time.time() - snapshot.stat(fname).st_mtime)
 		if (i < 60):
 			logging.debug("Skipping archive of file {}, it has recently been modified.".format(fname))
 			continue
@@ -67,59 +369,311 @@ def archive_timelapse_video(imagedir, archivedir):
 		target = os.path.join(archivedir, yyyymmdd, hh)
 		logging.info("Archiving {} to {}".format(fname, target))
 
-		if os.path.isfile(os.path.join(target,fname)):
+		if snapshot.archived(target, fname):
 			logging.warning("File {} already exists in {} during archiving.".format(fname, target))
 		else:
-			if not os.path.isdir(target):
-				os.makedirs(target)
-			shutil.copy(os.path.join(imagedir, fname), target)
+			snapshot.archiving(target, fname)
+			archive_file(imagedir, fname, target, rename = True)
+			RETENTION.add(archivedir, yyyymmdd, snapshot.size(fname))
+			indexed.append((target, fname, snapshot.size(fname)))
 		# remove avi files during archive. Image files are removed only after FTP upload was success.
 		remove_file(imagedir, fname)
 
-		
+	if INDEX:
+		INDEX.add(archivedir, indexed)
 	logging.info("Archiving timelapse done.")
 
-def resize_image(imagedir, imagefname, targetfile):
+def draft_image(im, box = (2000,720)):
+	# Lets the JPEG decoder scale down by 1/2, 1/4 or 1/8 while decoding.
+	# draft() keeps the image at least as big as the size it is given, so
+	# it needs the size thumbnail() ends up with, not the bounding box.
+	scale = min(1.0, float(box[0]) / im.size[0], float(box[1]) / im.size[1])
+	im.draft('RGB', (int(im.size[0] * scale), int(im.size[1] * scale)))
+
+def resize_image(imagedir, imagefname):
+	# returns the resized JPEG in a memory buffer
+	infile = os.path.join(imagedir, imagefname)
+	im = Image.open(infile)
+	draft_image(im)
+	im.thumbnail( (2000,720) )
+	data = io.BytesIO()
+	im.save(data, "JPEG", quality = 60)
+	logging.info('Resizing {} to {} bytes'.format(infile, data.tell()))
+	data.seek(0)
+	return data
+
+def fit_jpeg(im, target, quality, shrink = 0, qmin = 20, qmax = 90, maxshrink = 4):
+	# Encodes im to at most target bytes, in memory. Starting from the
+	# quality and scale that fitted the last frames of the camera, one
+	# encode is enough when the result lands between 80% and 100% of the
+	# target; otherwise the quality is bisected. When even qmin is too big
+	# the frame is scaled down by another quarter and tried again.
+	# Returns (data, quality, shrink, encodes).
+	encodes = 0
+	while True:
+		scale = 0.75 ** shrink
+		scaled = im.resize((int(im.size[0] * scale), int(im.size[1] * scale)), Image.BILINEAR) if shrink else im
+		lo, hi = qmin, qmax
+		q = max(qmin, min(qmax, quality))
+		best = None
+		while lo <= hi:
+			data = io.BytesIO()
+			scaled.save(data, "JPEG", quality = q)
+			encodes += 1
+			if data.tell() <= target:
+				best = (data, q)
+				if data.tell() >= target * 0.8:
+					break
+				lo = q + 1
+			else:
+				hi = q - 1
+			q = (lo + hi) // 2
+		if best:
+			return best[0], best[1], shrink, encodes
+		if shrink >= maxshrink:
+			return data, qmin, shrink, encodes
+		shrink += 1
+		quality = qmin
+
+def next_fit(quality, shrink, qmin = 20, qup = 80):
+	# what the next frame of a camera starts from: the same quality and
+	# scale, or one scale up again once the smaller one fits at qup or more
+	if shrink and quality >= qup:
+		return (qmin + qup) // 2, shrink - 1
+	return quality, shrink
+
+def resize_budget(imagedir, imagefname, target, quality, shrink = 0):
+	# resize_image with a byte budget instead of a fixed quality 60
 	infile = os.path.join(imagedir, imagefname)
 	im = Image.open(infile)
+	draft_image(im)
 	im.thumbnail( (2000,720) )
-	im.save(targetfile, "JPEG", quality = 60)
-	logging.info('Resizing {} to {}'.format(infile, targetfile.name))
+	data, quality, shrink, encodes = fit_jpeg(im, target, quality, shrink)
+	logging.info('Resizing {} to {} bytes for {}, quality {} at scale {:.2f} after {} encodes'.format(infile, data.tell(), \
+			target, quality, 0.75 ** shrink, encodes))
+	data.seek(0)
+	return data, quality, shrink, encodes
+
+def frame_target(imagedir):
+	# the byte budget of the next frames of a camera: --framebytes, or the
+	# --camerarate spread over the frames the camera currently produces
+	target = FRAMEBYTES
+	arrival = get_policy(imagedir).arrival
+	if CAMERARATE:
+		# until the arrival rate is known, one second worth per frame
+		share = max(CAMERARATE / arrival, 16384) if arrival else CAMERARATE
+		target = min(target or share, share)
+	return int(target) if target else None
 
 def get_files(image_dir, extension = 'JPG'):
 	fnames = sorted([f for f in os.listdir(image_dir) if f.upper().endswith(extension)])
 	return fnames
 
+class DirSnapshot(object):
+	# One read of a camera directory per pass, shared by the archive, age
+	# and upload stages. os.scandir lists the files and caches their stat
+	# results, so a file is stat'ed at most once per pass; Python 2 gets a
+	# listdir and stats on demand. The archive hour directories a pass
+	# writes to are listed once as well, instead of an isfile and isdir
+	# per frame.
+
+	def __init__(self, path):
+		self.path = path
+		self.entries = {}  # name -> DirEntry, or None without scandir
+		self.stats = {}
+		self.targets = {}  # archive dir -> set of names, None if missing
+		if scandir:
+			for entry in scandir(path):
+				if entry.is_file():
+					self.entries[entry.name] = entry
+		else:
+			for name in os.listdir(path):
+				self.entries[name] = None
+
+	def files(self, extension = 'JPG'):
+		return sorted([f for f in self.entries if f.upper().endswith(extension)])
+
+	def stat(self, fname):
+		st = self.stats.get(fname)
+		if st is None:
+			entry = self.entries.get(fname)
+			st = self.stats[fname] = entry.stat() if entry else os.stat(os.path.join(self.path, fname))
+		return st
+
+	def size(self, fname):
+		try:
+			return self.stat(fname).st_size
+		except OSError:
+			return 0
+
+	def age(self, fname):
+		try:
+			return int(time.time() - self.stat(fname).st_ctime)
+		except OSError:
+			return 0
+
+	def archived(self, target, fname):
+		if target not in self.targets:
+			try:
+				self.targets[target] = set(os.listdir(target))
+			except OSError:
+				self.targets[target] = None
+		return fname in (self.targets[target] or ())
+
+	def archiving(self, target, fname):
+		# creates the target directory the first time it is needed
+		if self.targets.get(target) is None:
+			if not os.path.isdir(target):
+				os.makedirs(target)
+			self.targets[target] = set()
+		self.targets[target].add(fname)
+
+class TokenBucket(object):
+	# Caps the combined rate of all FTP sessions at rate bytes/sec, with
+	# bursts of up to one second worth of data. Callers that overdraw the
+	# bucket sleep until it has refilled.
+
+	def __init__(self, rate):
+		self.rate = float(rate)
+		self.tokens = self.rate
+		self.last = time.time()
+		self.lock = threading.Lock()
+
+	def reserve(self, n):
+		# takes n tokens, returns the seconds to wait before using them
+		with self.lock:
+			now = time.time()
+			self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+			self.last = now
+			self.tokens -= n
+			return -self.tokens / self.rate
+
+	def consume(self, n):
+		wait = self.reserve(n)
+		if wait > 0:
+			time.sleep(wait)
+
+class TransferStats(object):
+	# Counts the bytes sent by all sessions and logs the aggregate rate
+	# every interval seconds, instead of a log record per block.
+
+	def __init__(self, interval = 60):
+		self.interval = interval
+		self.lock = threading.Lock()
+		self.sent = 0
+		self.since = time.time()
+
+	def add(self, n):
+		with self.lock:
+			self.sent += n
+			now = time.time()
+			if now - self.since < self.interval:
+				return
+			sent, elapsed = self.sent, now - self.since
+			self.sent, self.since = 0, now
+		logging.info('Upload rate {:.1f} KB/s, {} bytes in the last {:.0f}s.'.format(sent / 1024.0 / elapsed, sent, elapsed))
+
 def ftp_callback(block):
-	logging.debug('Sent block...')
-
-def get_ftphandle(username, password):
-	global FTPH
-	if not FTPH:
-		logging.info('Connecting to FTP server.')
-		FTPH = FTP(timeout=60)
-		FTPH.set_debuglevel(0) # https://docs.python.org/2/library/ftplib.html#ftplib.FTP.set_debuglevel
-		FTPH.connect('ftp.cammy.com',10021)
-		FTPH.login(username, password)
-	return FTPH
-
-def close_ftphandle():
-	global FTPH
-	try:
-		if FTPH:
-			FTPH.quit()
-	except ftplib.all_errors as e:
-		logging.exception('Exception during closing the FTP handle')
-	FTPH = None
+	TRANSFERS.add(len(block))
+	if BWLIMIT:
+		BWLIMIT.consume(len(block))
+
+TRANSFERS = TransferStats()
+
+def get_blocksize(size):
+	# unless --blocksize is given, send a frame in about 8 blocks of 16-256 KB
+	if BLOCKSIZE:
+		return BLOCKSIZE
+	return max(16384, min(262144, size // 8))
+
+class FTPPool(object):
+	# A bounded set of logged in FTP sessions shared by all upload threads.
+	# Idle sessions get a NOOP before they are reused, and a broken session
+	# is just dropped so the next acquire() logs in a fresh one without
+	# disturbing the sessions other threads are using.
+
+	def __init__(self, host, port, username, password, size, idlecheck = 30):
+		self.host = host
+		self.port = port
+		self.username = username
+		self.password = password
+		self.idlecheck = idlecheck
+		self.slots = threading.Semaphore(size)
+		self.lock = threading.Lock()
+		self.idle = []  # (ftph, last used)
+
+	def _connect(self):
+		logging.info('Connecting to FTP server {}:{}.'.format(self.host, self.port))
+		METRICS.inc('cammy_ftp_connects_total')
+		ftph = FTP(timeout=60)
+		ftph.set_debuglevel(0) # https://docs.python.org/2/library/ftplib.html#ftplib.FTP.set_debuglevel
+		try:
+			ftph.connect(self.host, self.port)
+			ftph.login(self.username, self.password)
+		except ftplib.all_errors:
+			ftph.close()
+			raise
+		return ftph
+
+	def _close(self, ftph):
+		try:
+			ftph.quit()
+		except ftplib.all_errors as e:
+			logging.debug('Exception during closing the FTP handle: {}'.format(e))
+			ftph.close()
+
+	def acquire(self):
+		self.slots.acquire()
+		try:
+			while True:
+				with self.lock:
+					if not self.idle:
+						break
+					ftph, last_used = self.idle.pop()
+				if time.time() - last_used < self.idlecheck:
+					return ftph
+				try:
+					ftph.voidcmd('NOOP')
+					return ftph
+				except ftplib.all_errors as e:
+					logging.info('Dropping stale FTP session: {}'.format(e))
+					ftph.close()
+			return self._connect()
+		except:
+			self.slots.release()
+			raise
+
+	def release(self, ftph, broken = False):
+		if broken:
+			self._close(ftph)
+		else:
+			with self.lock:
+				self.idle.append((ftph, time.time()))
+		self.slots.release()
+
+	def closeall(self):
+		with self.lock:
+			idle, self.idle = self.idle, []
+		for ftph, last_used in idle:
+			self._close(ftph)
 
-def ftp_put(ftph, imagedir, imagefile):
+def ftp_put(ftph, imagedir, imagefile, data = None):
 	sent = False
 	try:
 		imagefname = os.path.join(imagedir, imagefile)
 		logging.info("FTP STOR {}".format(imagefname))
-		resp = ftph.storbinary("STOR " + imagefile, open(imagefname,'rb'), blocksize = 4096, callback = ftp_callback)
-		ftph.voidcmd('NOOP')
-		logging.info("FTP STOR response code {}".format(resp))
+		started = time.time()
+		if data:
+			size = len(data.getvalue())
+			data.seek(0)
+			resp = ftph.storbinary("STOR " + imagefile, data, blocksize = get_blocksize(size), callback = ftp_callback)
+		else:
+			with open(imagefname,'rb') as f:
+				size = os.fstat(f.fileno()).st_size
+				resp = ftph.storbinary("STOR " + imagefile, f, blocksize = get_blocksize(size), callback = ftp_callback)
+		elapsed = max(time.time() - started, 0.001)
+		logging.info("FTP STOR response code {} ({} bytes, {:.1f} KB/s)".format(resp, size, size / 1024.0 / elapsed))
+		METRICS.inc('cammy_upload_bytes_total', (('camera', get_camera(imagedir)),), size)
 		sent = True
 	except ftplib.all_errors as e:
 		logging.exception('Exception during putting image')
@@ -129,9 +683,12 @@ def ftp_put(ftph, imagedir, imagefile):
 
 def remove_file(imagedir, fname):
 	f = os.path.join(imagedir, fname)
-	if os.path.isfile(f):
-		logging.info("Removing {}".format(f))
+	try:
 		os.remove(f)
+		logging.info("Removing {}".format(f))
+	except OSError as e:
+		if e.errno != errno.ENOENT:
+			raise
 		
 def get_fileage(imagedir, fname):
 	try:
@@ -140,67 +697,612 @@ def get_fileage(imagedir, fname):
 		i = 0 
 	return i
 
-def ftp_putall(imagedir, username, password, delete, archivedir, archivedays, resize):
+def backoff_delay(attempt, base = 1, cap = 60):
+	# exponential backoff with jitter, so sessions do not retry in lockstep
+	return min(cap, base * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+
+class ConnectionHealth(object):
+	# Circuit breaker for the FTP server, shared by all sessions. After
+	# `threshold` failures in a row the circuit opens and no upload is tried
+	# until a jittered, exponentially growing backoff has passed. Then one
+	# trial upload is let through (half-open): success closes the circuit,
+	# failure opens it again for longer.
+
+	CLOSED = 'closed'
+	HALF_OPEN = 'half-open'
+	OPEN = 'open'
+
+	def __init__(self, threshold = 5, backoff = 10, maxbackoff = 600):
+		self.threshold = threshold
+		self.backoff = backoff
+		self.maxbackoff = maxbackoff
+		self.lock = threading.Lock()
+		self.state = self.CLOSED
+		self.failures = 0
+		self.opened = 0
+		self.retry_at = 0
+		self.trial = False
+
+	def _set_state(self, state, detail = ''):
+		logging.warning('FTP circuit {} -> {}{}'.format(self.state, state, detail))
+		self.state = state
+		METRICS.set('cammy_ftp_circuit_state', (), {self.CLOSED: 0, self.HALF_OPEN: 1, self.OPEN: 2}[state])
+		METRICS.inc('cammy_ftp_circuit_changes_total', (('state', state),))
 
+	def allow(self):
+		# may an upload be tried now?
+		with self.lock:
+			if self.state == self.CLOSED:
+				return True
+			if self.state == self.OPEN:
+				if time.time() < self.retry_at:
+					return False
+				self._set_state(self.HALF_OPEN)
+			if self.trial:
+				return False
+			self.trial = True
+			return True
+
+	def is_open(self):
+		with self.lock:
+			return self.state == self.OPEN and time.time() < self.retry_at
+
+	def success(self):
+		with self.lock:
+			self.failures = 0
+			self.opened = 0
+			self.trial = False
+			if self.state != self.CLOSED:
+				self._set_state(self.CLOSED)
+
+	def failure(self):
+		with self.lock:
+			self.failures += 1
+			self.trial = False
+			if self.state == self.OPEN:
+				return
+			if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+				self.opened += 1
+				delay = backoff_delay(self.opened, self.backoff, self.maxbackoff)
+				self.retry_at = time.time() + delay
+				self._set_state(self.OPEN, ' after {} failures, next try in {:.0f}s'.format(self.failures, delay))
+
+HEALTH = ConnectionHealth()
+
+def upload_file(imagedir, fname, data = None):
+	# Returns True once the frame is stored. Gives up after 10 attempts, or
+	# straight away while the FTP circuit is open, leaving the frame queued.
+	labels = (('camera', get_camera(imagedir)),)
+	started = time.time()
+	if TRACER:
+		TRACER.mark(imagedir, fname, 'upload_start', started)
 	uploaded = False
+	retrycount = 0
+	while not uploaded and retrycount < 10:
+		if retrycount:
+			time.sleep(backoff_delay(retrycount))
+		if not HEALTH.allow():
+			logging.info('FTP circuit is open, leaving {} queued.'.format(fname))
+			break
+		if retrycount:
+			METRICS.inc('cammy_upload_retries_total', labels)
+		try:
+			ftph = FTPPOOL.acquire()
+		except ftplib.all_errors as e:
+			logging.exception('Exception during connecting to FTP server')
+			HEALTH.failure()
+			retrycount += 1
+			continue
+		uploaded = ftp_put(ftph, imagedir, fname, data)
+		FTPPOOL.release(ftph, broken = not uploaded)
+		if uploaded:
+			HEALTH.success()
+		else:
+			HEALTH.failure()
+			logging.info('Problem during storing {}, retrying'.format(fname))
+			retrycount += 1
+	METRICS.observe('cammy_upload_seconds', labels, time.time() - started)
+	if uploaded:
+		METRICS.inc('cammy_frames_uploaded_total', labels)
+		if TRACER:
+			TRACER.mark(imagedir, fname, 'upload_end', retries = retrycount)
+	return uploaded
+
+def resize_frame(imagedir, fname, target = None, quality = 60, shrink = 0):
+	# runs in a RESIZERS process, bytes pickle cheaper than a BytesIO;
+	# returns the data, start and end times for the tracer, and the quality,
+	# scale and number of encodes used
+	started = time.time()
+	if target:
+		data, quality, shrink, encodes = resize_budget(imagedir, fname, target, quality, shrink)
+	else:
+		data, encodes = resize_image(imagedir, fname), 1
+	return data.getvalue(), started, time.time(), quality, shrink, encodes
+
+def log_resized(imagedir):
+	stats = ENCODES[imagedir]
+	if stats['frames']:
+		logging.info('Resized frames of {} so far: {}, {:.0f} bytes and {:.2f} encodes per frame, budget {}, quality {}.'.format( \
+				imagedir, stats['frames'], stats['bytes'] / float(stats['frames']), stats['encodes'] / float(stats['frames']), \
+				frame_target(imagedir), QUALITIES.get(imagedir, (None,))[0]))
+
+def resize_submit(imagedir, fname):
+	# arguments for resize_frame with the camera's current budget, quality and scale
+	return (imagedir, fname, frame_target(imagedir)) + QUALITIES.get(imagedir, (60, 0))
+
+def resized_frame(imagedir, fname, result):
+	# bookkeeping for a frame back from resize_frame, returns its data
+	data, started, finished, quality, shrink, encodes = result
+	if TRACER:
+		TRACER.mark(imagedir, fname, 'resize_start', started)
+		TRACER.mark(imagedir, fname, 'resize_end', finished)
+	QUALITIES[imagedir] = next_fit(quality, shrink)
+	labels = (('camera', get_camera(imagedir)),)
+	METRICS.inc('cammy_resized_frames_total', labels)
+	METRICS.inc('cammy_resized_bytes_total', labels, len(data))
+	METRICS.inc('cammy_resize_encodes_total', labels, encodes)
+	METRICS.set('cammy_resize_quality', labels, quality)
+	stats = ENCODES[imagedir]
+	stats['frames'] += 1
+	stats['bytes'] += len(data)
+	stats['encodes'] += encodes
+	return data
+
+def resize_frames(imagedir, fnames, resize):
+	# Yields (fname, data) in the order of fnames while the RESIZERS pool
+	# works on the next frames. At most RESIZEAHEAD resized frames are held
+	# in memory.
+	if not resize:
+		for fname in fnames:
+			yield fname, None
+		return
+
+	def resized(fname, result):
+		return fname, io.BytesIO(resized_frame(imagedir, fname, result.get()))
+
+	pending = collections.deque()
+	for fname in fnames:
+		pending.append((fname, RESIZERS.apply_async(resize_frame, resize_submit(imagedir, fname))))
+		if len(pending) >= RESIZEAHEAD:
+			yield resized(*pending.popleft())
+	while pending:
+		yield resized(*pending.popleft())
+
+def ewma(average, value, weight = 0.3):
+	if average is None:
+		return value
+	return (1 - weight) * average + weight * value
+
+class BacklogPolicy(object):
+	# Decides which frames of a camera are sent in a pass and in which order.
+	# It tracks how fast frames arrive and how fast they are uploaded. When
+	# the backlog cannot be cleared before frames reach MAXAGE, frames older
+	# than THINAGE are thinned to 1 in N rather than all being sent late and
+	# then dropped at the age limit. Decisions are counted in counters.
+
+	def __init__(self):
+		self.arrival = None  # frames/sec
+		self.drain = None    # frames/sec
+		self.names = set()
+		self.seen_at = None
+		self.counters = collections.Counter()
+
+	def observe(self, fnames):
+		now = time.time()
+		names = set(fnames)
+		if self.seen_at is not None and now > self.seen_at:
+			self.arrival = ewma(self.arrival, len(names - self.names) / (now - self.seen_at))
+		self.names, self.seen_at = names, now
+
+	def uploaded(self, count, elapsed):
+		if count and elapsed > 0:
+			self.drain = ewma(self.drain, count / elapsed)
+
+	def thinning(self, backlog):
+		# keep 1 in this many old frames
+		if not self.drain:
+			return 1
+		capacity = (self.drain - (self.arrival or 0)) * MAXAGE
+		if capacity >= backlog:
+			return 1
+		return int(math.ceil(backlog / max(capacity, 1.0)))
+
+	def plan(self, imagedir, fnames, snapshot = None, thin = True):
+		# returns the frames to send, in sending order, and the frames to drop;
+		# without thin only frames past MAXAGE are dropped
+		self.observe(fnames)
+		n = self.thinning(len(fnames)) if thin else 1
+		send = []
+		drop = []
+		old = 0
+		for fname in fnames:
+			age = snapshot.age(fname) if snapshot else get_fileage(imagedir, fname)
+			if age > MAXAGE:
+				self.counters['dropped_age'] += 1
+				METRICS.inc('cammy_frames_dropped_total', (('camera', get_camera(imagedir)), ('reason', 'age')))
+				drop.append(fname)
+			elif age > THINAGE and n > 1:
+				if old % n:
+					self.counters['dropped_thinned'] += 1
+					METRICS.inc('cammy_frames_dropped_total', (('camera', get_camera(imagedir)), ('reason', 'thinned')))
+					drop.append(fname)
+				else:
+					send.append(fname)
+				old += 1
+			else:
+				send.append(fname)
+		self.counters['planned'] += len(send)
+		if ORDER == 'newest':
+			send.reverse()
+
+		logging.info('Backlog {} frames, arrival {:.2f}/s, drain {:.2f}/s, keeping 1 in {} old frames.'.format( \
+				len(fnames), self.arrival or 0, self.drain or 0, n))
+		return send, drop
+
+def get_policy(imagedir):
+	if imagedir not in POLICIES:
+		POLICIES[imagedir] = BacklogPolicy()
+	return POLICIES[imagedir]
+
+class FrameDeduper(object):
+	# Skips frames that look like the last frame sent for the camera, using a
+	# 64 bit difference hash: the frame is decoded at 1/8 scale in draft mode,
+	# shrunk to 9x8 grey pixels and every bit tells whether a pixel is
+	# brighter than its left neighbour. Frames within threshold bits of each
+	# other count as duplicates. Hashes are cached so a frame that stays
+	# queued after a failed upload is not decoded again.
+
+	def __init__(self, threshold, cachesize = 4096):
+		self.threshold = threshold
+		self.cachesize = cachesize
+		self.lock = threading.Lock()
+		self.hashes = collections.OrderedDict()  # (imagedir, fname) -> hash
+		self.last = {}                           # imagedir -> (fname, hash) of the last frame sent
+		self.counters = collections.defaultdict(int)
+
+	def dhash(self, imagedir, fname):
+		key = (imagedir, fname)
+		with self.lock:
+			if key in self.hashes:
+				return self.hashes[key]
+		try:
+			im = Image.open(os.path.join(imagedir, fname))
+			im.draft('L', (72, 64))
+			pixels = numpy.asarray(im.convert('L').resize((9, 8), Image.BILINEAR), dtype = numpy.int16)
+		except (IOError, OSError, ValueError) as e:
+			logging.warning('Cannot hash {}: {}'.format(fname, e))
+			return None
+		value = 0
+		for byte in bytearray(numpy.packbits(pixels[:, 1:] > pixels[:, :-1]).tobytes()):
+			value = (value << 8) | byte
+		with self.lock:
+			self.hashes[key] = value
+			while len(self.hashes) > self.cachesize:
+				self.hashes.popitem(last = False)
+		return value
+
+	def duplicate(self, imagedir, fname):
+		# True when fname may be skipped, otherwise it becomes the frame the
+		# following ones are compared with
+		value = self.dhash(imagedir, fname)
+		if value is None:
+			return False
+		last = self.last.get(imagedir)
+		if last and last[0] != fname and bin(last[1] ^ value).count('1') <= self.threshold:
+			return True
+		self.last[imagedir] = (fname, value)
+		return False
+
+	def skipped(self, imagedir, fname, size):
+		with self.lock:
+			self.hashes.pop((imagedir, fname), None)
+		labels = (('camera', get_camera(imagedir)),)
+		METRICS.inc('cammy_frames_deduped_total', labels)
+		METRICS.inc('cammy_dedupe_bytes_saved_total', labels, size)
+		self.counters[(imagedir, 'frames')] += 1
+		self.counters[(imagedir, 'bytes')] += size
+
+class FrameTracer(object):
+	# Follows a sample of the frames from capture to deletion and writes one
+	# JSON line per frame when it is done with:
+	#   {"camera": "01", "frame": "20151117_211520_01.jpg", "capture": 1447791320.0,
+	#    "result": "uploaded", "retries": 0, "stages": {"detect": 0.8, ...}}
+	# The capture time comes from the frame name, the stages (detect,
+	# resize_start, resize_end, upload_start, upload_end, delete) are seconds
+	# after capture. Whether a frame is sampled depends only on its name, so
+	# a frame retried over several passes stays in or out of the sample.
+
+	def __init__(self, path, sample = 1.0, maxopen = 10000):
+		self.path = path
+		self.sample = int(sample * 10000)
+		self.maxopen = maxopen
+		self.lock = threading.Lock()
+		self.open = collections.OrderedDict()  # (imagedir, fname) -> record
+		self.out = open(path, 'a')
+
+	def sampled(self, fname):
+		return zlib.crc32(fname.encode('utf-8')) % 10000 < self.sample
+
+	def capture_time(self, fname):
+		# motion names frames YYYYMMDD_HHMMSS_NN.jpg
+		try:
+			return time.mktime((int(fname[0:4]), int(fname[4:6]), int(fname[6:8]), \
+					int(fname[9:11]), int(fname[11:13]), int(fname[13:15]), 0, 0, -1))
+		except ValueError:
+			return None
+
+	def detected(self, imagedir, fnames, when = None):
+		when = when or time.time()
+		with self.lock:
+			for fname in fnames:
+				key = (imagedir, fname)
+				if key in self.open or not self.sampled(fname):
+					continue
+				capture = self.capture_time(fname)
+				if capture is None:
+					continue
+				self.open[key] = {'camera': get_camera(imagedir), 'frame': fname, 'capture': capture, \
+						'stages': {'detect': round(when - capture, 3)}}
+			while len(self.open) > self.maxopen:
+				self.open.popitem(last = False)
+
+	def mark(self, imagedir, fname, stage, when = None, **extra):
+		with self.lock:
+			record = self.open.get((imagedir, fname))
+			if record is None:
+				return
+			# the first time counts, a retried frame keeps its first upload_start
+			record['stages'].setdefault(stage, round((when or time.time()) - record['capture'], 3))
+			record.update(extra)
+
+	def finish(self, imagedir, fnames, result):
+		now = time.time()
+		with self.lock:
+			for fname in fnames:
+				record = self.open.pop((imagedir, fname), None)
+				if record is None:
+					continue
+				record['stages']['delete'] = round(now - record['capture'], 3)
+				record['result'] = result
+				self.out.write(json.dumps(record, sort_keys = True) + '\n')
+			self.out.flush()
+
+def put_frame(imagedir, fname, data, delete):
+	# frames that could not be sent stay for the next pass
+	uploaded = upload_file(imagedir, fname, data)
+
+	if uploaded:
+		if delete:
+			remove_file(imagedir, fname)
+		if TRACER:
+			TRACER.finish(imagedir, [fname], 'uploaded')
+	return uploaded
+
+def ftp_putall(imagedir, delete, archivedir, archivedays, resize):
+
 	up_count = 0
+	started = time.time()
+	journal = get_journal(imagedir)
+	policy = get_policy(imagedir)
+	labels = (('camera', get_camera(imagedir)),)
+	if journal and time.time() - journal.pruned > 3600:
+		journal.prune(86400)
 	while True and delete:
-		fnames = get_files(imagedir)
+		snapshot = DirSnapshot(imagedir)
+		fnames = snapshot.files()
 		logging.info('^^^ Processing {}, number of images = {}'.format(imagedir, len(fnames)))
+		METRICS.set('cammy_queue_depth', labels, len(fnames))
 		if len(fnames) == 0:
 			break
+		if TRACER:
+			TRACER.detected(imagedir, fnames)
 
-		if archivedir:
-			archive_images2(imagedir, archivedir, archivedays)
-			archive_timelapse_video(imagedir, archivedir)
-			
-		i = 0
-		retrycount = 0
+		if journal:
+			journal.mark([f for f in fnames if not journal.state(f)], 'seen')
 
-		for i in range(len(fnames)):
-			fname = fnames[i]
+		if archivedir:
+			archive_started = time.time()
+			archive_images2(imagedir, archivedir, archivedays, journal, snapshot)
+			archive_timelapse_video(imagedir, archivedir, snapshot)
+			METRICS.observe('cammy_archive_seconds', labels, time.time() - archive_started)
 
+		frames = []
+		for fname in fnames:
 			if fname.endswith('_sml.jpg'):
 				continue
-
-			logging.info("Putting image {}, {} of {}".format(fname, i, len(fnames)))
-
-			if get_fileage(imagedir, fname) > (60*30) and delete:
-				logging.warning("Frame drop! Dropping {}".format(fname))
+			if journal and journal.state(fname) in ('uploaded', 'dropped'):
+				# left over from before a restart
 				remove_file(imagedir, fname)
 				continue
+			frames.append(fname)
 
+		# during an outage the drain rate is stale, frames only go at MAXAGE
+		outage = HEALTH.is_open()
+		frames, dropped = policy.plan(imagedir, frames, snapshot, thin = not outage)
+		for fname in dropped:
+			logging.warning("Frame drop! Dropping {}".format(fname))
+			remove_file(imagedir, fname)
+		if journal:
+			journal.mark(dropped, 'dropped')
+		if TRACER:
+			TRACER.finish(imagedir, dropped, 'dropped')
 
-			orig_fname = fname
-			tmpfile = tempfile.NamedTemporaryFile()
-			if resize:
-				resize_image(imagedir, fname, tmpfile)
-				fname = tmpfile.name
+		if outage:
+			logging.info('FTP circuit is open, leaving {} frames of {} queued.'.format(len(frames), imagedir))
+			break
 
-			uploaded = False
-			retrycount = 0
-			while not uploaded and retrycount < 10:
-				ftph = get_ftphandle(username, password)
-				uploaded = ftp_put(ftph, imagedir, fname)
-				if not uploaded:
-					logging.info('Problem during storing {}, retrying'.format(fname))
-					close_ftphandle()
-					retrycount += 1
-				else:
-					up_count += 1
+		if DEDUPER:
+			# duplicates are already archived, they only skip the upload
+			duplicates = [f for f in frames if DEDUPER.duplicate(imagedir, f)]
+			for fname in duplicates:
+				logging.info("Skipping {}, it looks like the previous frame.".format(fname))
+				DEDUPER.skipped(imagedir, fname, snapshot.size(fname))
+				if delete:
+					remove_file(imagedir, fname)
+			if journal:
+				journal.mark(duplicates, 'dropped')
+			if TRACER:
+				TRACER.finish(imagedir, duplicates, 'duplicate')
+			duplicates = set(duplicates)
+			frames = [f for f in frames if f not in duplicates]
+
+		# Resizing runs ahead in RESIZERS while earlier frames go out over
+		# several FTP sessions. Uploads are started in the order the policy
+		# chose and at most UPLOADAHEAD of them are queued.
+		# The uploaded frames are journaled once at the end of the pass. A
+		# frame is deleted right after its upload, so a crash before that
+		# commit only resends frames that were uploaded but not yet
+		# deleted, as without the journal.
+		pass_started = time.time()
+		uploads = collections.deque()
+		sent = []
+		try:
+			for i, (fname, data) in enumerate(resize_frames(imagedir, frames, resize)):
+				if HEALTH.is_open():
+					break
+				logging.info("Putting image {}, {} of {}".format(fname, i, len(frames)))
+				uploads.append((fname, UPLOADERS.apply_async(put_frame, (imagedir, fname, data, delete))))
+				if len(uploads) >= UPLOADAHEAD:
+					done, result = uploads.popleft()
+					if result.get():
+						sent.append(done)
+			while uploads:
+				done, result = uploads.popleft()
+				if result.get():
+					sent.append(done)
+		finally:
+			if journal:
+				journal.mark(sent, 'uploaded')
+		up_count += len(sent)
+		policy.uploaded(len(sent), time.time() - pass_started)
+		if len(sent) < len(frames):
+			# some frames are still there, try them again on the next pass
+			break
 
-			if delete:
-				remove_file(imagedir, orig_fname)
-			
-	close_ftphandle()
-	logging.info('@@@ Finished processing {}. Uploaded {} images.'.format(imagedir, up_count))
+	elapsed = time.time() - started
+	logging.info('@@@ Finished processing {}. Uploaded {} images in {:.1f}s, {:.2f} frames/sec.'.format(imagedir, up_count, \
+			elapsed, up_count / elapsed if elapsed > 0 else 0))
+	logging.info('Frames of {} so far: {} planned, {} dropped by age, {} thinned.'.format(imagedir, \
+			policy.counters['planned'], policy.counters['dropped_age'], policy.counters['dropped_thinned']))
+	log_resized(imagedir)
+	if DEDUPER:
+		logging.info('Duplicates of {} so far: {} frames, {:.1f} KB not sent.'.format(imagedir, \
+				DEDUPER.counters[(imagedir, 'frames')], DEDUPER.counters[(imagedir, 'bytes')] / 1024.0))
 
-	return uploaded	
+	return up_count > 0
 	
 	
+def put_camera(args, camera):
+	logging.info('Scanning camera {}...'.format(camera))
+	cam_imagedir = os.path.join(args.imagedir, camera)
+	cam_archivedir = os.path.join(args.archivedir, camera)
 
-def main():
+	return ftp_putall(cam_imagedir, args.delete, cam_archivedir, args.archivedays, args.resize)
+
+class CameraScheduler(object):
+	# Runs a handler for each camera on a pool of worker threads. A camera is
+	# never handled by two workers at once. After a pass that uploaded
+	# something the camera rests for the cooldown (so cammy thinks the next
+	# frames are a new event) on a timer, while the workers carry on with the
+	# other cameras.
+
+	def __init__(self, handler, workers, cooldown):
+		self.handler = handler
+		self.cooldown = cooldown
+		self.lock = threading.Lock()
+		self.queue = queue.Queue()
+		self.busy = set()     # queued, running or cooling down
+		self.pending = set()  # submitted again while busy
+		for i in range(workers):
+			t = threading.Thread(target=self._worker, name='worker-{}'.format(i))
+			t.daemon = True
+			t.start()
+
+	def submit(self, camera):
+		with self.lock:
+			if camera in self.busy:
+				self.pending.add(camera)
+				return
+			self.busy.add(camera)
+		self.queue.put(camera)
+
+	def _worker(self):
+		while True:
+			camera = self.queue.get()
+			uploaded = False
+			try:
+				uploaded = self.handler(camera)
+			except Exception as e:
+				logging.exception('Unexpected exception while handling camera {}'.format(camera))
+
+			if uploaded and self.cooldown > 0:
+				logging.info('Camera {} cooling down for {} seconds.'.format(camera, self.cooldown))
+				timer = threading.Timer(self.cooldown, self._release, [camera])
+				timer.daemon = True
+				timer.start()
+			else:
+				self._release(camera)
+
+	def _release(self, camera):
+		with self.lock:
+			self.busy.discard(camera)
+			again = camera in self.pending
+			self.pending.discard(camera)
+		if again:
+			self.submit(camera)
+
+def watch_cameras(args, scheduler):
+	camdirs = dict((camera, os.path.join(args.imagedir, camera)) for camera in args.cameras)
+	watcher = DirWatcher(camdirs)
+	# a backlog left from before a restart is not announced by any event
+	for camera in args.cameras:
+		scheduler.submit(camera)
+	last_rescan = time.time()
+	while True:
+		cameras = watcher.wait(args.rescan)
+		if time.time() - last_rescan >= args.rescan:
+			# periodic full rescan in case events were lost
+			cameras = set(args.cameras)
+			last_rescan = time.time()
+		for camera in args.cameras:
+			if camera in cameras:
+				scheduler.submit(camera)
+
+def notify_camera(name, camdirs):
+	# a notification names a camera, its directory or a file in it
+	if name in camdirs.values():
+		return name
+	path = os.path.abspath(name)
+	for camdir, camera in camdirs.items():
+		if path == camdir or path.startswith(camdir + os.sep):
+			return camera
+	return None
 
+def listen_cameras(args, scheduler):
+	# cammy_notify.py sends one datagram per event, the scheduler merges
+	# notifications for a camera that is already queued or busy
+	camdirs = dict((os.path.abspath(os.path.join(args.imagedir, camera)), camera) for camera in args.cameras)
+	try:
+		os.unlink(args.socket)
+	except OSError:
+		pass
+	sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+	sock.bind(args.socket)
+	os.chmod(args.socket, 0o660)
+	logging.info('Listening for notifications on {}.'.format(args.socket))
+	while True:
+		name = sock.recv(4096).decode('utf-8', 'replace').strip()
+		camera = notify_camera(name, camdirs)
+		if camera is None:
+			logging.warning('Notification for unknown camera {}.'.format(name))
+			continue
+		logging.debug('Notification for camera {}.'.format(camera))
+		METRICS.inc('cammy_notifications_total', (('camera', camera),))
+		scheduler.submit(camera)
+
+
+def build_parser():
+	# shared with cammy_put_async.py, both engines take the same options
 	parser = argparse.ArgumentParser(description='Cammy FTP Uploader.')
 	parser.add_argument('-u', dest='username', required=True, help='Cammy FTP username')
 	parser.add_argument('-p', dest='password', required=True, help='Cammy FTP password')
@@ -209,14 +1311,73 @@ def main():
 	parser.add_argument('--delete', help='Delete images after uploading', action='store_true', default=False)
 	parser.add_argument('--resize', help='Resize images before sending to cammy', action='store_true', default=False)
 	parser.add_argument('--archivedir', help='Archive directory', default=None)
+	parser.add_argument('--archivemode', help='copy frames into the archive, or hardlink frames and move videos', choices=['copy', 'link'], default='copy')
+	parser.add_argument('--archiveformat', help='one file per frame, or the frames of each hour appended to one pack file (see cammy_pack.py)', choices=['files', 'pack'], default='files')
+	parser.add_argument('--index', help='Time index of the archive shared with organize.py, see cammy_index.py', default=None)
+	parser.add_argument('--journaldir', help='Directory for the per camera frame journals', default=None)
 	parser.add_argument('--archivedays', help='Number of days of history to keep in archive', default=10)
+	parser.add_argument('--archivequota', help='Megabytes of archive to keep per camera, oldest days are removed first', default=None, type=int)
 	parser.add_argument('--cameras', help='List of camera subdirs, e.g. 01 02 03', nargs='+', required=True)
+	parser.add_argument('--watch', help='Wait for inotify events instead of polling the camera dirs every second', action='store_true', default=False)
+	parser.add_argument('--socket', help='Unix socket to receive new frame notifications from cammy_notify.py on', default=None)
+	parser.add_argument('--rescan', help='Seconds between full rescans in --watch or --socket mode', default=60, type=float)
+	parser.add_argument('--workers', help='Number of cameras uploaded concurrently', default=4, type=int)
+	parser.add_argument('--ftphost', help='FTP server host', default='ftp.cammy.com')
+	parser.add_argument('--ftpport', help='FTP server port', default=10021, type=int)
+	parser.add_argument('--ftpsessions', help='Number of FTP sessions uploading in parallel', default=3, type=int)
+	parser.add_argument('--blocksize', help='FTP transfer block size in bytes, 0 picks one per frame', default=0, type=int)
+	parser.add_argument('--bwlimit', help='Limit the combined upload rate to this many KB/s', default=0, type=float)
+	parser.add_argument('--order', help='Send the oldest or the newest frames of a backlog first', choices=['oldest', 'newest'], default='oldest')
+	parser.add_argument('--maxage', help='Minutes after which a frame is dropped instead of sent', default=30, type=float)
+	parser.add_argument('--thinage', help='Seconds after which frames may be thinned when the backlog cannot be cleared in time', default=120, type=float)
+	parser.add_argument('--metricsport', help='Serve Prometheus metrics over HTTP on this port', default=None, type=int)
+	parser.add_argument('--metricsfile', help='Write Prometheus metrics to this file for the textfile collector', default=None)
+	parser.add_argument('--breakafter', help='Consecutive FTP failures that open the circuit breaker', default=5, type=int)
+	parser.add_argument('--backoff', help='Seconds the circuit stays open the first time, doubled on each further failure', default=10, type=float)
+	parser.add_argument('--maxbackoff', help='Longest time in seconds the circuit stays open', default=600, type=float)
+	parser.add_argument('--framebytes', help='With --resize, pick the JPEG quality so a frame fits this many bytes', default=None, type=int)
+	parser.add_argument('--camerarate', help='With --resize, fit the frames of a camera into this many KB/s at the rate they arrive', default=None, type=float)
+	parser.add_argument('--resizers', help='Number of processes resizing frames ahead of the upload', default=2, type=int)
+	parser.add_argument('--dedupe', help='Skip frames within this many bits (of 64) of the last frame sent, needs numpy', default=None, type=int)
+	parser.add_argument('--trace', help='Write per frame latency traces as JSON lines to this file, see cammy_trace.py', default=None)
+	parser.add_argument('--tracesample', help='Fraction of the frames to trace', default=0.1, type=float)
+	parser.add_argument('--cooldown', help='Seconds a camera rests after an upload so cammy sees a new event', default=60, type=float)
 
-	args = parser.parse_args()
+	return parser
+
+def configure(parser, args):
+	# sets the module settings both engines share from the parsed options
+	global ARCHIVEMODE, ARCHIVEFORMAT, JOURNALDIR, BLOCKSIZE, BWLIMIT, ORDER, MAXAGE, THINAGE, HEALTH, ARCHIVEQUOTA, DEDUPER, TRACER, \
+		FRAMEBYTES, CAMERARATE, INDEX
+	ARCHIVEMODE = args.archivemode
+	ARCHIVEFORMAT = args.archiveformat
+	if args.index:
+		INDEX = TimeIndex(args.index)
+		RETENTION.index = INDEX
+	if args.archivequota:
+		ARCHIVEQUOTA = args.archivequota * 1048576
+	if args.dedupe is not None:
+		if numpy is None:
+			parser.error('--dedupe needs numpy')
+		DEDUPER = FrameDeduper(args.dedupe)
+	JOURNALDIR = args.journaldir
+	BLOCKSIZE = args.blocksize
+	ORDER = args.order
+	MAXAGE = args.maxage * 60
+	THINAGE = args.thinage
+	if args.bwlimit:
+		BWLIMIT = TokenBucket(args.bwlimit * 1024)
+	HEALTH = ConnectionHealth(args.breakafter, args.backoff, args.maxbackoff)
+	if args.trace:
+		TRACER = FrameTracer(args.trace, args.tracesample)
+	FRAMEBYTES = args.framebytes
+	if args.camerarate:
+		CAMERARATE = args.camerarate * 1024
 
-	logFormatter = logging.Formatter("%(asctime)s [%(levelname)-5.5s]  %(message)s")
+def setup_logging(logfile):
+	logFormatter = logging.Formatter("%(asctime)s [%(levelname)-5.5s] [%(threadName)s]  %(message)s")
 	rootLogger = logging.getLogger()
-	fileHandler = logging.handlers.RotatingFileHandler(args.log, maxBytes=(1048576*5), backupCount=7)
+	fileHandler = logging.handlers.RotatingFileHandler(logfile, maxBytes=(1048576*5), backupCount=7)
 	fileHandler.setFormatter(logFormatter)
 	rootLogger.addHandler(fileHandler)
 
@@ -226,23 +1387,52 @@ def main():
 
 	rootLogger.setLevel(logging.DEBUG)
 
+def start_metrics(args):
+	if args.metricsport:
+		serve_metrics(args.metricsport)
+	if args.metricsfile:
+		t = threading.Thread(target=write_metrics, args=(args.metricsfile, 15), name='metrics')
+		t.daemon = True
+		t.start()
+
+def main():
+
+	parser = build_parser()
+	args = parser.parse_args()
+	configure(parser, args)
+
+	global FTPPOOL, UPLOADERS, UPLOADAHEAD, RESIZERS, RESIZEAHEAD
+	if args.resize:
+		# fork the resize processes before any logging handlers or threads exist
+		RESIZERS = multiprocessing.Pool(args.resizers)
+		RESIZEAHEAD = args.resizers * 2
+
+	setup_logging(args.log)
+
 	logging.info('CammyPut2 started.')
 
+	FTPPOOL = FTPPool(args.ftphost, args.ftpport, args.username, args.password, args.ftpsessions)
+	UPLOADERS = ThreadPool(args.ftpsessions)
+	UPLOADAHEAD = args.ftpsessions * 2
 
-	while True:
-		for camera in args.cameras:
-			logging.info('Scanning camera {}...'.format(camera))
-			cam_imagedir = os.path.join(args.imagedir, camera)
-			cam_archivedir = os.path.join(args.archivedir, camera)
+	start_metrics(args)
+
+	scheduler = CameraScheduler(lambda camera: put_camera(args, camera), args.workers, args.cooldown)
+
+	if args.socket:
+		t = threading.Thread(target=listen_cameras, args=(args, scheduler), name='notify')
+		t.daemon = True
+		t.start()
 
-			uploaded = ftp_putall(cam_imagedir, args.username, args.password, args.delete, cam_archivedir, \
-						args.archivedays, args.resize)
+	if args.watch:
+		watch_cameras(args, scheduler)
 
-			if uploaded:
-				# pause for cammy to think theres a new event
-				time.sleep(60)
+	while True:
+		for camera in args.cameras:
+			scheduler.submit(camera)
 
-		time.sleep(1)
+		# with notifications the scan is only a safety net
+		time.sleep(args.rescan if args.socket else 1)
 
 
 
@@ -0,0 +1,202 @@
+#!/usr/bin/python
+
+# Retention of the day directories (YYYYMMDD) in the archive and in the
+# Foscam record directories.
+#
+# With a quota a root is walked once when it is registered, after that the
+# per-day size totals are kept up to date by add() as files are archived
+# and by the deletions themselves, with a fresh walk every few hours to
+# catch files written by someone else. The walks run on the background
+# thread, so registering never holds up an upload pass. enforce() only
+# decides from these totals which days go: everything beyond the newest N
+# days, then the oldest days until the root fits its quota. The newest day
+# is never removed. The actual rmtree runs in the same background thread at
+# the lowest CPU priority, so a big deletion never holds up the caller.
+# With an index set (a TimeIndex of cammy_index.py) the rows of a day are
+# dropped as the day is queued.
+
+import os.path
+import os
+import time
+import logging
+import shutil
+import threading
+try:
+	import queue
+except ImportError:
+	import Queue as queue
+
+
+def is_day_dir(name):
+	return len(name) == 8 and name.isdigit()
+
+def list_days(root):
+	if not os.path.isdir(root):
+		return []
+	return [name for name in os.listdir(root) if is_day_dir(name) and os.path.isdir(os.path.join(root, name))]
+
+def disk_usage(path):
+	# bytes allocated to all files below path
+	total = 0
+	for dirpath, dirnames, filenames in os.walk(path):
+		for fname in filenames:
+			try:
+				st = os.lstat(os.path.join(dirpath, fname))
+			except OSError:
+				continue
+			total += getattr(st, 'st_blocks', 0) * 512 or st.st_size
+	return total
+
+
+class Retention(object):
+
+	def __init__(self, resync = 6 * 3600, nice = 19):
+		self.resync = resync
+		self.nice = nice
+		self.lock = threading.Lock()
+		self.roots = {}
+		self.queue = queue.Queue()
+		self.worker = None
+		self.index = None
+
+	def register(self, root, days, quota = None):
+		# quota in bytes, None for day counts only. Day counts only need the
+		# day names, which are listed right here. With a quota the sizes come
+		# from a walk queued on the background thread; until it is done the
+		# incremental totals are used.
+		with self.lock:
+			info = self.roots.get(root)
+			fresh = info is not None and info['scanned'] and time.time() - info['scanned'] < self.resync
+		if not quota and not fresh:
+			days_found = list_days(root)
+		with self.lock:
+			info = self.roots.get(root)
+			if info is None:
+				info = self.roots[root] = {'sizes': {}, 'scanned': None, 'scanning': False, \
+						'sized': False, 'during': {}, 'gone': set(), 'pending': None}
+			info['days'] = int(days)
+			info['quota'] = quota
+			if not quota:
+				if not fresh:
+					info['sizes'] = dict((day, info['sizes'].get(day, 0)) for day in days_found)
+					info['scanned'] = time.time()
+				return
+			if info['scanning'] or (info['scanned'] and info['sized'] and time.time() - info['scanned'] < self.resync):
+				return
+			info['scanning'] = True
+			info['during'] = {}
+			info['gone'] = set()
+		self.submit(('scan', root))
+
+	def add(self, root, day, nbytes):
+		# account a file stored below root/day
+		with self.lock:
+			info = self.roots.get(root)
+			if info is not None:
+				info['sizes'][day] = info['sizes'].get(day, 0) + nbytes
+				if info['scanning']:
+					info['during'][day] = info['during'].get(day, 0) + nbytes
+
+	def scan(self, root):
+		# on the background thread: replaces the totals of root by a walk.
+		# Files added while it runs may be counted twice until the next
+		# walk, days queued for removal meanwhile are left out.
+		started = time.time()
+		try:
+			sizes = dict((day, disk_usage(os.path.join(root, day))) for day in list_days(root))
+		except OSError as e:
+			logging.warning("Retention: cannot walk {}: {}".format(root, e))
+			with self.lock:
+				self.roots[root]['scanning'] = False
+			return
+		with self.lock:
+			info = self.roots[root]
+			for day, nbytes in info['during'].items():
+				sizes[day] = sizes.get(day, 0) + nbytes
+			for day in info['gone']:
+				sizes.pop(day, None)
+			info['sizes'] = sizes
+			info['scanned'] = time.time()
+			info['sized'] = True
+			info['scanning'] = False
+			pending, info['pending'] = info['pending'], None
+		logging.info("Retention: {} uses {:.1f} MB in {} days, walked in {:.1f} s.".format(root, \
+				sum(sizes.values()) / 1048576.0, len(sizes), time.time() - started))
+		if pending is not None:
+			# a quota enforce() had to skip
+			self.enforce(root, pending)
+
+	def usage(self, root):
+		with self.lock:
+			info = self.roots.get(root)
+			return sum(info['sizes'].values()) if info else 0
+
+	def enforce(self, root, dryrun = False):
+		# returns the days queued for removal
+		with self.lock:
+			info = self.roots.get(root)
+			if info is None:
+				return []
+			sizes = info['sizes']
+			days = sorted(sizes, reverse = True)
+			expired = days[max(info['days'], 1):]
+			kept = days[:max(info['days'], 1)]
+			if info['quota'] and not info['sized']:
+				# the sizes are not known yet, scan() enforces the quota
+				info['pending'] = dryrun
+			elif info['quota']:
+				total = sum(sizes[d] for d in kept)
+				while len(kept) > 1 and total > info['quota']:
+					day = kept.pop()
+					total -= sizes[day]
+					expired.append(day)
+			if not dryrun:
+				for day in expired:
+					del sizes[day]
+					if info['scanning']:
+						info['gone'].add(day)
+
+		for day in expired:
+			logging.info("Removing {}".format(os.path.join(root, day)))
+			if dryrun:
+				logging.info('DRY-RUN. Skipped.')
+			else:
+				self.remove(os.path.join(root, day))
+				if self.index:
+					self.index.remove_day(root, day)
+		return expired
+
+	def remove(self, path):
+		self.submit(('remove', path))
+
+	def submit(self, job):
+		with self.lock:
+			if self.worker is None:
+				self.worker = threading.Thread(target = self.run, name = 'retention')
+				self.worker.daemon = True
+				self.worker.start()
+		self.queue.put(job)
+
+	def run(self):
+		# on Linux nice() only lowers the priority of this thread
+		try:
+			os.nice(self.nice)
+		except (OSError, AttributeError) as e:
+			logging.debug("Retention: cannot lower priority: {}".format(e))
+		while True:
+			job, path = self.queue.get()
+			try:
+				if job == 'scan':
+					self.scan(path)
+				else:
+					started = time.time()
+					shutil.rmtree(path, True)
+					logging.info("Removed {} in {:.1f} s.".format(path, time.time() - started))
+			except Exception as e:
+				logging.exception("Retention: {} of {} failed".format(job, path))
+			finally:
+				self.queue.task_done()
+
+	def wait(self):
+		# for one-shot runs: block until the queued walks and deletions are done
+		self.queue.join()
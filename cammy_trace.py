@@ -0,0 +1,97 @@
+#!/usr/bin/python
+
+# Summarizes the frame traces written by cammy_put_d.py --trace: latency
+# percentiles per camera and stage, in seconds.
+#
+#   detect  - capture until the uploader first saw the frame
+#   queue   - seen until its upload started
+#   resize  - resize start until end, with --resize only
+#   upload  - upload start until the STOR was confirmed, retries included
+#   total   - capture until the frame was deleted
+#
+# Frames dropped by the backlog policy or skipped as duplicates only count
+# towards detect and total.
+
+import math
+import json
+import argparse
+import collections
+
+STAGES = [
+	('detect', None, 'detect'),
+	('queue', 'detect', 'upload_start'),
+	('resize', 'resize_start', 'resize_end'),
+	('upload', 'upload_start', 'upload_end'),
+	('total', None, 'delete'),
+]
+
+def percentile(values, p):
+	# nearest rank on sorted values
+	if not values:
+		return None
+	rank = int(math.ceil(p / 100.0 * len(values))) - 1
+	return values[max(0, min(len(values) - 1, rank))]
+
+def read_traces(files, camera = None):
+	for path in files:
+		with open(path) as f:
+			for line in f:
+				try:
+					record = json.loads(line)
+				except ValueError:
+					continue
+				if camera and record.get('camera') != camera:
+					continue
+				yield record
+
+def summarize(records):
+	# returns {(camera, stage): sorted latencies} and {(camera, result): count}
+	latencies = collections.defaultdict(list)
+	results = collections.Counter()
+	for record in records:
+		stages = record.get('stages', {})
+		results[(record.get('camera'), record.get('result'))] += 1
+		for name, start, end in STAGES:
+			if end not in stages or (start and start not in stages):
+				continue
+			latencies[(record.get('camera'), name)].append(stages[end] - (stages[start] if start else 0))
+	for values in latencies.values():
+		values.sort()
+	return latencies, results
+
+def main():
+
+	parser = argparse.ArgumentParser(description='Cammy frame latency summary.')
+	parser.add_argument('files', help='Trace files written by --trace', nargs='+')
+	parser.add_argument('--camera', help='Only this camera', default=None)
+	parser.add_argument('--json', help='Print the summary as JSON lines', action='store_true', default=False)
+	args = parser.parse_args()
+
+	latencies, results = summarize(read_traces(args.files, args.camera))
+	cameras = sorted(set(camera for camera, stage in latencies))
+
+	if args.json:
+		for camera in cameras:
+			for name, start, end in STAGES:
+				values = latencies.get((camera, name))
+				if values:
+					print(json.dumps({'camera': camera, 'stage': name, 'frames': len(values), \
+							'p50': round(percentile(values, 50), 3), 'p95': round(percentile(values, 95), 3), \
+							'p99': round(percentile(values, 99), 3)}))
+		return
+
+	print('{:<8} {:<8} {:>7} {:>9} {:>9} {:>9}'.format('camera', 'stage', 'frames', 'p50', 'p95', 'p99'))
+	for camera in cameras:
+		for name, start, end in STAGES:
+			values = latencies.get((camera, name))
+			if values:
+				print('{:<8} {:<8} {:>7} {:>9.3f} {:>9.3f} {:>9.3f}'.format(camera, name, len(values), \
+						percentile(values, 50), percentile(values, 95), percentile(values, 99)))
+	print('')
+	print('{:<8} {:<10} {:>7}'.format('camera', 'result', 'frames'))
+	for (camera, result), count in sorted(results.items(), key = lambda item: (str(item[0][0]), str(item[0][1]))):
+		print('{:<8} {:<10} {:>7}'.format(camera, result, count))
+
+
+if __name__ == '__main__':
+	main()
@@ -10,19 +10,145 @@ import logging
 import logging.handlers
 import argparse
 import shutil
+import errno
+import collections
+import json
+import socket
+import threading
 from datetime import datetime
 from datetime import timedelta
-from urllib2 import Request, urlopen, URLError
+from multiprocessing.pool import ThreadPool
+from cammy_retention import Retention
+from cammy_inotify import Inotify
+from cammy_index import TimeIndex
+try:
+    from http.client import HTTPConnection, HTTPException
+    from urllib.parse import urlencode
+except ImportError:
+    from httplib import HTTPConnection, HTTPException
+    from urllib import urlencode
+
+RETENTION = Retention()
+INDEX = None
 
 def unix_time(dt):
     epoch = datetime.utcfromtimestamp(0)
     return (dt - epoch).total_seconds() 
 
-def check_for_cat(catmon, catmac, catlogdir, filename, midx, movies):
-    logging.debug('Checking for cat: catmon={}; filename={}'.format(catmon, filename))
-
-    if not catmac or not catmon:
-        return
+class CatMonitor(object):
+    # Client for the cat monitor on the Raspberry Pi. The lookups of a pass
+    # run concurrently, every worker thread keeps its own keep-alive
+    # connection with a strict timeout, and answers are cached by
+    # (mac, timestamp) in a JSON file so a movie is only asked about once.
+    #
+    # With batch=True many timestamps go in one request with a when= per
+    # timestamp; the monitor then answers with a "<when> <sightings>" line
+    # per timestamp. If the batch request fails, single lookups are used.
+
+    def __init__(self, catmon, catmac, timeout = 5, workers = 4, cachefile = None, batch = False):
+        self.host = catmon
+        self.mac = catmac.lower()
+        self.timeout = timeout
+        self.workers = workers
+        self.cachefile = cachefile
+        self.batch = batch
+        self.local = threading.local()
+        self.cache = {}
+        if cachefile and os.path.isfile(cachefile):
+            try:
+                with open(cachefile) as f:
+                    self.cache = json.load(f)
+            except ValueError as e:
+                logging.warning('Ignoring broken cat cache {}: {}'.format(cachefile, e))
+
+    def _query(self, timestamps):
+        #http://rpi:8080/?mac=e3:e2:e9:74:22:4b&when=20161101221000&threshold=-85&period=120
+        return urlencode([('mac', self.mac)] + [('when', ts) for ts in timestamps] + \
+                         [('threshold', -90), ('period', 2)])
+
+    def _get(self, query):
+        # returns the response lines; a second attempt covers a keep-alive
+        # connection the monitor has closed in the meantime
+        for attempt in range(2):
+            conn = getattr(self.local, 'conn', None)
+            if conn is None:
+                conn = self.local.conn = HTTPConnection(self.host, timeout = self.timeout)
+            try:
+                conn.request('GET', '/?' + query)
+                response = conn.getresponse()
+                body = response.read().decode('utf-8', 'replace')
+            except (HTTPException, socket.error) as e:
+                conn.close()
+                self.local.conn = None
+                if attempt:
+                    raise
+                continue
+            if response.status != 200:
+                raise HTTPException('{} {}'.format(response.status, response.reason))
+            return body.splitlines()
+
+    def _lookup(self, ts):
+        try:
+            data = self._get(self._query([ts]))
+        except (HTTPException, socket.error) as e:
+            logging.warning('Cat monitor {} failed for {}: {}'.format(self.host, ts, e))
+            return ts, None
+        logging.debug('Cat check {} returns {} '.format(ts, data))
+        return ts, len(data) > 1
+
+    def _lookup_batch(self, timestamps):
+        try:
+            data = self._get(self._query(timestamps))
+        except (HTTPException, socket.error) as e:
+            logging.warning('Cat monitor {} batch lookup failed: {}'.format(self.host, e))
+            return {}
+        found = {}
+        for line in data:
+            fields = line.split()
+            if len(fields) == 2 and fields[0] in timestamps and fields[1].isdigit():
+                found[fields[0]] = int(fields[1]) > 0
+        return found
+
+    def lookup(self, timestamps):
+        # returns {timestamp: cat seen}; timestamps the monitor could not
+        # answer are left out and not cached
+        key = lambda ts: '{}/{}'.format(self.mac, ts)
+        found = dict((ts, self.cache[key(ts)]) for ts in timestamps if key(ts) in self.cache)
+        todo = [ts for ts in timestamps if key(ts) not in self.cache]
+        logging.info('Cat lookups: {} cached, {} to ask.'.format(len(found), len(todo)))
+
+        answers = {}
+        if todo and self.batch:
+            for i in range(0, len(todo), 50):
+                answers.update(self._lookup_batch(todo[i:i + 50]))
+            todo = [ts for ts in todo if ts not in answers]
+        if todo:
+            pool = ThreadPool(min(self.workers, len(todo)))
+            try:
+                answers.update((ts, seen) for ts, seen in pool.map(self._lookup, todo) if seen is not None)
+            finally:
+                pool.close()
+
+        found.update(answers)
+        if answers:
+            self.cache.update((key(ts), seen) for ts, seen in answers.items())
+            self.save()
+        return found
+
+    def save(self, days = 14):
+        if not self.cachefile:
+            return
+        cutoff = (datetime.now() - timedelta(days = days)).strftime('%Y%m%d%H%M%S')
+        self.cache = dict((k, v) for k, v in self.cache.items() if k.split('/')[-1] >= cutoff)
+        try:
+            with open(self.cachefile + '.tmp', 'w') as f:
+                json.dump(self.cache, f)
+            os.rename(self.cachefile + '.tmp', self.cachefile)
+        except (IOError, OSError) as e:
+            logging.warning('Cannot write cat cache {}: {}'.format(self.cachefile, e))
+
+def check_for_cat(catresults, catlogdir, filename, midx, index):
+    logging.debug('Checking for cat: filename={}'.format(filename))
 
 
     # tt = get_movie_triggertime(movie)
@@ -35,16 +161,16 @@ def check_for_cat(catmon, catmac, catlogdir, filename, midx, movies):
     #  else:
     #    inbound cat event
 
-    (ts, tt) = get_movie_triggertime(os.path.basename(filename), "Current")
+    (_, ts, tt) = index[midx]
     
     direction = "outbound"
 
     previous_tt = None
     next_tt = None
     if midx > 0:
-        (_, previous_tt) = get_movie_triggertime(movies[midx - 1], "Previous")
-    if midx < len(movies) - 1:
-        (_, next_tt) = get_movie_triggertime(movies[midx + 1], "Next")
+        previous_tt = index[midx - 1][2]
+    if midx < len(index) - 1:
+        next_tt = index[midx + 1][2]
 
     td = timedelta(minutes=1)
 
@@ -55,67 +181,143 @@ def check_for_cat(catmon, catmac, catlogdir, filename, midx, movies):
     else:
         direction = "in"
 
-    #http://rpi:8080/?mac=e3:e2:e9:74:22:4b&when=20161101221000&threshold=-85&period=120
-
-    url = "http://{}/?mac={}&when={}&threshold=-90&period=2".format(catmon, catmac.lower(), ts)
-
-    req = Request(url)
-    try:
-        response = urlopen(req)
-        data = response.readlines()
-        logging.debug('Cat check returns {} '.format(data))
-        if len(data) > 1 and catlogdir:
-            try:
-                catlogdir = os.path.join(catlogdir, direction)
-                logging.info('Cat detected! Copying movie from {} to {}'.format(filename, catlogdir))
-                shutil.copy2(filename, catlogdir)
-            except Exception as e:
-                traceback.print_exc()
-        else:
-            logging.info('No cat detected.')
-
-    except URLError as e:
-        if hasattr(e, 'reason'):
-            print 'We failed to reach a server.'
-            print 'Reason: ', e.reason
-        elif hasattr(e, 'code'):
-            print 'The server couldn\'t fulfill the request.'
-            print 'Error code: ', e.code
+    if ts not in catresults:
+        logging.info('Cat monitor gave no answer.')
+    elif catresults[ts] and catlogdir:
+        try:
+            catlogdir = os.path.join(catlogdir, direction)
+            logging.info('Cat detected! Copying movie from {} to {}'.format(filename, catlogdir))
+            shutil.copy2(filename, catlogdir)
+        except Exception as e:
+            traceback.print_exc()
+    else:
+        logging.info('No cat detected.')
 
 
 
 
 
-def cleanup(target, days, dryrun = False):
+def cleanup(target, days, dryrun = False, quota = None):
+    # quota in bytes per camera; the day directories are removed in the
+    # background, see RETENTION.wait()
     logging.info("Cleaning old movies, days to keep {}...".format(days))
     cameras = os.listdir(target)
     for camera in cameras:
         logging.info("Cleanup of camera {}".format(camera))
-        day_dirs = sorted(os.listdir(os.path.join(target, camera, 'record')), reverse = True)
-        for day_dir in day_dirs[days:]:
-            logging.info("Removing {}".format(day_dir))
-            if dryrun:
-                logging.info('DRY-RUN. Skipped.')
-            else:
-                shutil.rmtree(os.path.join(target, camera, 'record', day_dir), True)
+        recorddir = os.path.join(target, camera, 'record')
+        RETENTION.register(recorddir, days, quota)
+        RETENTION.enforce(recorddir, dryrun)
     logging.info("Cleaning done.")
 
 
 def get_movie_triggertime(filename, debug_comment=''):
     # parse the timestamp out of the filename and return tuple of string and datetime
-    logging.debug("Getting {} movie {} trigger time.".format(debug_comment, filename))
-    yyyymmdd = filename.split('_')[1]
-    hhmmss = filename.split('_')[2][:6]
-    ts = '{}{}'.format(yyyymmdd, hhmmss)
-    tt = datetime.strptime(ts, '%Y%m%d%H%M%S')
-    return (ts, tt)
+    # [S|M]Dalarm_YYYYMMDD_HHMMSS.mkv is fixed width, so slice instead of strptime
+    f = filename
+    if f[7] != '_' or f[16] != '_':
+        raise ValueError('Not a Foscam alarm movie: {}'.format(filename))
+    tt = datetime(int(f[8:12]), int(f[12:14]), int(f[14:16]), int(f[17:19]), int(f[19:21]), int(f[21:23]))
+    return (f[8:16] + f[17:23], tt)
+
+
+def movie_index(movies):
+    # one parse per movie and pass: a list of (movie, ts, tt) in trigger time
+    # order, so neighbours of index[i] are index[i - 1] and index[i + 1]
+    index = []
+    for movie in movies:
+        if not movie[1:].startswith('Dalarm_'):
+            continue
+        try:
+            (ts, tt) = get_movie_triggertime(movie)
+        except (ValueError, IndexError) as e:
+            logging.warning("Skipping {}: {}".format(movie, e))
+            continue
+        index.append((movie, ts, tt))
+    index.sort(key = lambda m: (m[1], m[0]))
+    return index
+
+
+def move_file(src, new_dir):
+    # a plain rename within the FTP filesystem, a copy only across filesystems
+    try:
+        os.rename(src, os.path.join(new_dir, os.path.basename(src)))
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(src, new_dir)
+
+
+def organize_camera(target, camera, dryrun = False, catcam = None, catmonitor = None, catlogdir = None, \
+                    movies = None, context = ()):
+    # Organizes the given movies of a camera, all of its record directory by
+    # default. context holds (movie, ts, tt) of movies organized earlier, which
+    # the cat heuristic still needs as neighbours. Returns the moved entries.
+    logging.info("Processing camera {}".format(camera))
+    if movies is None:
+        movies = os.listdir(os.path.join(target, camera, 'record'))
+
+    # filter files to only those "*Dalarm_"
+    index = movie_index(movies)
+    settled = datetime.now() - timedelta(minutes = 1)
+    neighbours = index
+    if context:
+        neighbours = sorted(set(index) | set(context), key = lambda m: (m[1], m[0]))
+    position = dict((m[0], i) for i, m in enumerate(neighbours))
+
+    catresults = {}
+    if camera == catcam and catmonitor:
+        # ask about all movies of this pass at once
+        catresults = catmonitor.lookup([ts for (_, ts, tt) in index if tt <= settled])
+
+    # the move plan: target hour directory -> movies, built before anything
+    # moves so a dry run logs exactly what a real run does
+    plan = collections.OrderedDict()
+    for midx, (movie, ts, tt) in enumerate(index):
+
+        logging.info("Processing movie {}".format(movie))
+        if ( tt > settled ):
+            logging.info("Movie is too fresh, so skipping this pass.")
+            continue
+
+        if camera == catcam and catmonitor:
+            check_for_cat(catresults, catlogdir, os.path.join(target, camera, 'record', movie), \
+                          position[movie], neighbours)
+
+        new_dir = os.path.join(target, camera, 'record', ts[:8], ts[8:10])
+        plan.setdefault(new_dir, []).append((movie, ts, tt))
+
+    moved = []
+    indexed = []
+    for new_dir, batch in plan.items():
+        logging.info("Moving {} files to {}".format(len(batch), new_dir))
+        if dryrun:
+            for (movie, _, _) in batch:
+                logging.info("DRY-RUN. Moving file {} skipped.".format(movie))
+            continue
+        if not os.path.isdir(new_dir):
+            os.makedirs(new_dir)
+        for entry in batch:
+            try:
+                move_file(os.path.join(target, camera, 'record', entry[0]), new_dir)
+                size = os.path.getsize(os.path.join(new_dir, entry[0]))
+                RETENTION.add(os.path.join(target, camera, 'record'), entry[1][:8], size)
+                indexed.append((new_dir, entry[0], size))
+                moved.append(entry)
+            except Exception as e:
+                traceback.print_exc()
+    if INDEX:
+        INDEX.add(os.path.join(target, camera, 'record'), indexed)
+    logging.info("Camera {}: {} movies in {} directories, {} moved.".format(camera, \
+                 sum(len(b) for b in plan.values()), len(plan), len(moved)))
+    return moved
 
 
-def organize(target, dryrun = False, catcam = None, catmon = None, catmac = None, catlogdir = None):
+def organize(target, dryrun = False, catcam = None, catmonitor = None, catlogdir = None, workers = 4):
     # Foscam writes into the root FTP directory as follows:
     # <camera_id>/record/[S|M]Dalarm_YYYYMMDD_HHMMSS.mkv
     # What we want to do, is move those files into directories:
     # <camera_id>/record/YYYYMMDD/HH/[S|M]Dalarm_YYYYMMDD_HHMMSS.mkv
+    # Cameras are independent, so they are organized in parallel.
 
     try:
         os.makedirs(os.path.join(catlogdir, 'out'))
@@ -123,43 +325,148 @@ def organize(target, dryrun = False, catcam = None, catmon = None, catmac = None
     except:
         pass
 
-    cameras = os.listdir(target)
-    for camera in cameras:
-        logging.info("Processing camera {}".format(camera))
-        movies = os.listdir(os.path.join(target, camera, 'record'))
-
-        # filter files to only those "*Dalarm_"
-        movies = sorted([m for m in movies if m[1:].startswith('Dalarm_')])
+    def run(camera):
+        try:
+            return len(organize_camera(target, camera, dryrun, catcam, catmonitor, catlogdir))
+        except Exception as e:
+            traceback.print_exc()
+            return 0
 
-        for midx, movie in enumerate(movies):
-         
-            logging.info("Processing movie {}".format(movie))
-            movie_full_fname = os.path.join(target, camera, 'record', movie)
-            yyyymmdd = movie.split('_')[1]
-            hh = movie.split('_')[2 ][:2]
+    cameras = os.listdir(target)
+    if not cameras:
+        return 0
+    pool = ThreadPool(max(1, min(workers, len(cameras))))
+    try:
+        return sum(pool.map(run, cameras))
+    finally:
+        pool.close()
+
+
+class RecordWatcher(Inotify):
+    # Reports movies the cameras finished uploading into <camera>/record.
+    # Without inotify every wait() just times out and the daemon relies on
+    # its periodic rescan.
+
+    def __init__(self, target):
+        Inotify.__init__(self)
+        self.target = target
+
+    def add(self, camera):
+        if self.fd is None or camera in self.watching():
+            return
+        recorddir = os.path.join(self.target, camera, 'record')
+        if Inotify.add(self, recorddir, camera):
+            logging.info('Watching {} with inotify.'.format(recorddir))
+
+    def wait(self, timeout):
+        # Returns a list of (camera, movie), None when events were lost.
+        events = self.read(timeout)
+        if events is None:
+            return None
+        return [(camera, name) for camera, name in events if name[1:].startswith('Dalarm_') and name.endswith('.mkv')]
+
+
+class OrganizeDaemon(object):
+    # Organizes every movie once it has been left alone for the settle time,
+    # using one timer per pending movie instead of rescans. A rescan every
+    # so often picks up new cameras and anything inotify missed.
+
+    def __init__(self, target, settle = 60, dryrun = False, catcam = None, catmonitor = None, catlogdir = None):
+        self.target = target
+        self.settle = settle
+        self.dryrun = dryrun
+        self.catcam = catcam
+        self.catmonitor = catmonitor
+        self.catlogdir = catlogdir
+        self.watcher = RecordWatcher(target)
+        self.lock = threading.Lock()
+        self.timers = {}
+        self.locks = {}
+        # recently organized movies per camera, neighbours for the cat heuristic
+        self.recent = {}
+
+    def schedule(self, camera, movie, delay = None):
+        # (re)starts the settle timer of a movie, every write restarts it
+        with self.lock:
+            timer = self.timers.pop((camera, movie), None)
+            if timer:
+                timer.cancel()
+            timer = threading.Timer(self.settle if delay is None else delay, self.settled, (camera, movie))
+            timer.daemon = True
+            self.timers[(camera, movie)] = timer
+            timer.start()
+
+    def settled(self, camera, movie):
+        with self.lock:
+            if self.timers.get((camera, movie)) is threading.current_thread():
+                del self.timers[(camera, movie)]
+        try:
+            self.organize(camera, [movie])
+        except Exception as e:
+            traceback.print_exc()
+
+    def organize(self, camera, movies):
+        with self.lock:
+            lock = self.locks.setdefault(camera, threading.Lock())
+            recent = self.recent.setdefault(camera, collections.deque(maxlen = 20))
+        with lock:
+            recorddir = os.path.join(self.target, camera, 'record')
+            movies = [m for m in movies if os.path.isfile(os.path.join(recorddir, m))]
+            if not movies:
+                return
+            # every movie of the record dir is a neighbour, settling or not,
+            # only the given ones are moved
+            context = list(recent) + movie_index(os.listdir(recorddir))
+            moved = organize_camera(self.target, camera, self.dryrun, self.catcam, self.catmonitor, \
+                                    self.catlogdir, movies, context)
+            recent.extend(moved)
+
+        if self.dryrun:
+            return
+        # movies still too fresh by their trigger time come back when they are not
+        moved = set(m[0] for m in moved)
+        for (movie, ts, tt) in movie_index(movies):
+            wait = (tt + timedelta(minutes = 1) - datetime.now()).total_seconds()
+            if movie not in moved and wait > 0:
+                self.schedule(camera, movie, wait + 1)
+
+    def rescan(self):
+        for camera in sorted(os.listdir(self.target)):
+            recorddir = os.path.join(self.target, camera, 'record')
+            if not os.path.isdir(recorddir):
+                continue
+            self.watcher.add(camera)
+            with self.lock:
+                # movies with a running timer are still settling
+                movies = [m for m in os.listdir(recorddir) if (camera, m) not in self.timers]
+            try:
+                self.organize(camera, movies)
+            except Exception as e:
+                traceback.print_exc()
 
-            (_, tt) = get_movie_triggertime(movie)
-            if ( datetime.now() - tt < timedelta(minutes = 1) ):
-                logging.info("Movie is too fresh, so skipping this pass.")
+    def run(self, rescan):
+        self.rescan()
+        last = time.time()
+        while True:
+            movies = self.watcher.wait(max(1, rescan - (time.time() - last)))
+            if movies is None or time.time() - last >= rescan:
+                self.rescan()
+                last = time.time()
                 continue
+            for (camera, movie) in movies:
+                logging.debug("Movie {} of camera {} written.".format(movie, camera))
+                self.schedule(camera, movie)
+
 
-            if camera == catcam: 
-                check_for_cat(catmon, catmac, catlogdir, movie_full_fname, midx, movies)
+def cleanup_loop(target, days, dryrun, quota, interval):
+    # retention runs on its own schedule, apart from the organizing
+    while True:
+        try:
+            cleanup(target, days, dryrun, quota)
+        except Exception as e:
+            traceback.print_exc()
+        time.sleep(interval)
 
-            new_dir = os.path.join(target, camera, 'record', yyyymmdd, hh)
-            logging.info("Moving file {} to {}".format(movie, new_dir))
-            if not os.path.isdir(new_dir):
-                if dryrun:
-                    logging.info("DRY-RUN. Make directory skipped")
-                else:
-                    os.makedirs(new_dir)
-            if dryrun:
-                logging.info("DRY-RUN. Moving file skipped.")
-            else:
-                try:
-                    shutil.move(movie_full_fname, new_dir)
-                except Exception as e:
-        			traceback.print_exc()
 
 
 
@@ -173,10 +480,22 @@ def main():
     parser.add_argument('--dryrun', help='Just print, do nothing', action='store_true', default=False)
     parser.add_argument('--keep_days', help='Number of days of history to keep in archive', default=10,
                         type = int)
+    parser.add_argument('--quota', help='Megabytes of movies to keep per camera, oldest days are removed first', default=None,
+                        type = int)
+    parser.add_argument('--index', help='Time index of the movies shared with the uploaders, see cammy_index.py', default=None)
+    parser.add_argument('--workers', help='Number of cameras organized in parallel', default=4, type = int)
+    parser.add_argument('--daemon', help='Keep running and organize movies as they arrive', action='store_true', default=False)
+    parser.add_argument('--settle', help='Daemon: seconds a movie must be left alone before it is organized', default=60, type = float)
+    parser.add_argument('--rescan', help='Daemon: seconds between full rescans', default=600, type = float)
+    parser.add_argument('--cleanup_interval', help='Daemon: seconds between retention cleanups', default=3600, type = float)
     parser.add_argument('--catmon', help='Host:port of the cat monitor', default='rpi:8080')
     parser.add_argument('--catcam', help='Identifier of the catcam', default=None)
     parser.add_argument('--catmac', help='Cat Mac Address', default=None)
     parser.add_argument('--catlogdir', help='Path to copy video file for cat log', default='/tmp')
+    parser.add_argument('--cattimeout', help='Seconds to wait for the cat monitor', default=5, type = float)
+    parser.add_argument('--catworkers', help='Number of concurrent cat monitor lookups', default=4, type = int)
+    parser.add_argument('--catcache', help='File caching the cat monitor answers', default=None)
+    parser.add_argument('--catbatch', help='Ask the cat monitor about many movies in one request', action='store_true', default=False)
 
 
 
@@ -195,8 +514,29 @@ def main():
     rootLogger.setLevel(logging.DEBUG)
 
     logging.info('Foscam organizer started.')
-    organize(args.target, args.dryrun, args.catcam, args.catmon, args.catmac, args.catlogdir)
-    cleanup(args.target, args.keep_days, args.dryrun)
+    global INDEX
+    if args.index:
+        INDEX = TimeIndex(args.index)
+        RETENTION.index = INDEX
+    quota = args.quota * 1048576 if args.quota else None
+    catmonitor = None
+    if args.catmon and args.catmac:
+        catmonitor = CatMonitor(args.catmon, args.catmac, args.cattimeout, args.catworkers, args.catcache, args.catbatch)
+    if args.daemon:
+        try:
+            os.makedirs(os.path.join(args.catlogdir, 'out'))
+            os.makedirs(os.path.join(args.catlogdir, 'in'))
+        except:
+            pass
+        t = threading.Thread(target = cleanup_loop, name = 'cleanup', \
+                             args = (args.target, args.keep_days, args.dryrun, quota, args.cleanup_interval))
+        t.daemon = True
+        t.start()
+        OrganizeDaemon(args.target, args.settle, args.dryrun, args.catcam, catmonitor, args.catlogdir).run(args.rescan)
+    else:
+        organize(args.target, args.dryrun, args.catcam, catmonitor, args.catlogdir, args.workers)
+        cleanup(args.target, args.keep_days, args.dryrun, quota)
+        RETENTION.wait()
     logging.info('Foscam organizer finished.')
 
 